@@ -3,6 +3,8 @@
 import json
 import logging
 import uuid
+from collections.abc import AsyncIterator
+
 import httpx
 
 logger = logging.getLogger(__name__)
@@ -43,10 +45,27 @@ class AgentClient:
 
     async def query(self, message: str, sources_only: bool | None = None) -> str:
         """
-        Send a query to the agent and return the response.
+        Send a query to the agent and return the full response.
+
+        Args:
+            message: The query to send
+            sources_only: Override the default sources_only setting
+        """
+        result = "".join([delta async for delta in self.stream(message, sources_only)])
+        if not result:
+            logger.warning("No content extracted from agent response")
+            return "I couldn't generate a response. Please try again."
+
+        return result
+
+    async def stream(
+        self, message: str, sources_only: bool | None = None
+    ) -> AsyncIterator[str]:
+        """
+        Send a query to the agent and yield the response text as it is generated.
 
-        The agent uses AG-UI protocol with SSE streaming. We collect
-        the full response for Discord (which doesn't support streaming).
+        The agent uses AG-UI protocol with SSE streaming; each
+        TEXT_MESSAGE_CONTENT event's delta is yielded as soon as it arrives.
 
         Args:
             message: The query to send
@@ -59,6 +78,7 @@ class AgentClient:
 
         headers = {
             "Content-Type": "application/json",
+            "Accept": "text/event-stream",
             "x-user-roles": json.dumps(self.default_roles),
             "x-sources-only": "true" if use_sources_only else "false",
         }
@@ -81,15 +101,20 @@ class AgentClient:
         }
 
         try:
-            response = await self._client.post(
+            async with self._client.stream(
+                "POST",
                 self.base_url,
                 json=payload,
                 headers=headers,
-            )
-            response.raise_for_status()
+            ) as response:
+                if response.is_error:
+                    await response.aread()
+                response.raise_for_status()
 
-            # Parse SSE response and extract text content
-            return self._parse_agui_response(response.text)
+                async for line in response.aiter_lines():
+                    delta = self._parse_agui_line(line)
+                    if delta:
+                        yield delta
 
         except httpx.HTTPStatusError as e:
             logger.error(
@@ -100,36 +125,58 @@ class AgentClient:
             logger.error(f"Agent request error: {e}")
             raise
 
-    def _parse_agui_response(self, sse_text: str) -> str:
+    async def search_sources(self, message: str) -> str:
         """
-        Parse AG-UI SSE response and extract the assistant's message.
+        Search for sources without running the agent, returning a bulleted
+        list of human-readable source titles.
 
-        AG-UI sends events like:
-        - TEXT_MESSAGE_START
-        - TEXT_MESSAGE_CONTENT (with delta text)
-        - TEXT_MESSAGE_END
+        Args:
+            message: The query to search for
         """
-        content_parts = []
+        if not self._client:
+            raise RuntimeError("Agent client not initialized")
 
-        for line in sse_text.split("\n"):
-            if not line.startswith("data: "):
-                continue
+        headers = {
+            "Content-Type": "application/json",
+            "x-user-roles": json.dumps(self.default_roles),
+        }
 
-            try:
-                data = json.loads(line[6:])  # Skip "data: " prefix
+        try:
+            response = await self._client.post(
+                f"{self.base_url}/sources",
+                json={"query": message},
+                headers=headers,
+            )
+            response.raise_for_status()
+            return response.json()["text"]
 
-                # Handle TEXT_MESSAGE_CONTENT events
-                if data.get("type") == "TEXT_MESSAGE_CONTENT":
-                    delta = data.get("delta", "")
-                    if delta:
-                        content_parts.append(delta)
+        except httpx.HTTPStatusError as e:
+            logger.error(
+                f"Sources request failed: {e.response.status_code} - {e.response.text}"
+            )
+            raise
+        except Exception as e:
+            logger.error(f"Sources request error: {e}")
+            raise
 
-            except json.JSONDecodeError:
-                continue
+    def _parse_agui_line(self, line: str) -> str | None:
+        """
+        Parse one line of an AG-UI SSE response, returning its text if it has any.
 
-        result = "".join(content_parts)
-        if not result:
-            logger.warning("No content extracted from agent response")
-            return "I couldn't generate a response. Please try again."
+        AG-UI sends events like:
+        - TEXT_MESSAGE_START
+        - TEXT_MESSAGE_CONTENT (with delta text)
+        - TEXT_MESSAGE_END
+        """
+        if not line.startswith("data: "):
+            return None
 
-        return result
+        try:
+            data = json.loads(line[6:])  # Skip "data: " prefix
+        except json.JSONDecodeError:
+            return None
+
+        # Handle TEXT_MESSAGE_CONTENT events
+        if data.get("type") == "TEXT_MESSAGE_CONTENT":
+            return data.get("delta") or None
+        return None
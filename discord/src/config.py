@@ -26,6 +26,12 @@ class Config:
     rate_limit_user_seconds: int = 30
     rate_limit_global_per_minute: int = 20
 
+    # Streaming: minimum seconds between edits of a streamed response
+    stream_edit_seconds: float = 1.5
+
+    # Single-flight: seconds to keep answers for repeated queries (0 disables)
+    single_flight_ttl_seconds: int = 30
+
     # Observability
     log_level: str = "INFO"
     environment: str = "development"
@@ -84,6 +90,12 @@ class Config:
             rate_limit_global_per_minute=int(
                 os.environ.get("RATE_LIMIT_GLOBAL_PER_MINUTE", "20")
             ),
+            stream_edit_seconds=float(
+                os.environ.get("DISCORD_STREAM_EDIT_SECONDS", "1.5")
+            ),
+            single_flight_ttl_seconds=int(
+                os.environ.get("SINGLE_FLIGHT_TTL_SECONDS", "30")
+            ),
             log_level=os.environ.get("LOG_LEVEL", "INFO").upper(),
             environment=os.environ.get("ENVIRONMENT", "development"),
         )
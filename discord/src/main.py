@@ -6,7 +6,9 @@ A Discord bot that provides access to the Cavepedia AI assistant via /cavesearch
 
 import os
 import sys
+import time
 import logging
+from collections.abc import AsyncIterator
 
 # Load environment variables BEFORE other imports
 from dotenv import load_dotenv
@@ -33,6 +35,7 @@ from discord import app_commands
 from src.config import Config
 from src.agent_client import AgentClient
 from src.rate_limiter import RateLimiter
+from src.single_flight import SingleFlight
 
 
 class CavepediaBot(discord.Client):
@@ -53,6 +56,9 @@ class CavepediaBot(discord.Client):
             user_cooldown_seconds=config.rate_limit_user_seconds,
             global_per_minute=config.rate_limit_global_per_minute,
         )
+        self.single_flight = SingleFlight(
+            result_ttl_seconds=config.single_flight_ttl_seconds,
+        )
 
     async def setup_hook(self):
         """Called when the bot is starting up."""
@@ -121,16 +127,23 @@ class CavepediaBot(discord.Client):
                 f"Processing query from {interaction.user} in #{interaction.channel}: {query[:100]}..."
             )
 
-            response = await self.agent_client.query(query, sources_only=sources_only)
-
-            # Discord has a 2000 character limit
-            if len(response) > 2000:
-                chunks = self._split_response(response, max_length=1900)
-                await interaction.followup.send(chunks[0])
-                for chunk in chunks[1:]:
-                    await interaction.channel.send(chunk)
+            # identical concurrent questions share one agent request
+            key = self.single_flight.key(
+                query, self.agent_client.default_roles, sources_only
+            )
+            if sources_only:
+                # sources are formatted by the agent server without running the LLM
+                response = await self.single_flight.do(
+                    key, lambda: self.agent_client.search_sources(query)
+                )
+                await self._send_response(interaction, response)
             else:
-                await interaction.followup.send(response)
+                await self._stream_response(
+                    interaction,
+                    self.single_flight.stream(
+                        key, lambda: self.agent_client.stream(query, sources_only=False)
+                    ),
+                )
 
             logger.info(f"Response sent to {interaction.user}")
 
@@ -141,12 +154,69 @@ class CavepediaBot(discord.Client):
                 "Please try again later."
             )
 
+    async def _send_response(self, interaction: discord.Interaction, response: str):
+        """Send a complete response as the deferred follow-up."""
+        # Discord has a 2000 character limit
+        if len(response) > 2000:
+            chunks = self._split_response(response, max_length=1900)
+            await interaction.followup.send(chunks[0])
+            for chunk in chunks[1:]:
+                await interaction.channel.send(chunk)
+        else:
+            await interaction.followup.send(response)
+
+    async def _stream_response(
+        self, interaction: discord.Interaction, deltas: AsyncIterator[str]
+    ):
+        """
+        Show a streamed response by editing the deferred follow-up as text arrives.
+
+        Edits are throttled to one every stream_edit_seconds to stay within
+        Discord's edit rate limits; text past the character limit continues in
+        new channel messages, which are edited the same way.
+        """
+        text = ""
+        messages: list[discord.Message] = []
+        shown: list[str] = []
+        last_update = 0.0
+
+        async def update():
+            for i, chunk in enumerate(self._split_response(text, max_length=1900)):
+                if i >= len(messages):
+                    if i == 0:
+                        message = await interaction.followup.send(chunk, wait=True)
+                    else:
+                        message = await interaction.channel.send(chunk)
+                    messages.append(message)
+                    shown.append(chunk)
+                elif shown[i] != chunk:
+                    await messages[i].edit(content=chunk)
+                    shown[i] = chunk
+
+        async for delta in deltas:
+            text += delta
+            now = time.monotonic()
+            if text.strip() and now - last_update >= self.config.stream_edit_seconds:
+                await update()
+                last_update = now
+
+        if not text.strip():
+            text = "I couldn't generate a response. Please try again."
+        await update()
+
     def _split_response(self, text: str, max_length: int = 1900) -> list[str]:
         """Split a long response into chunks that fit Discord's limit."""
         chunks = []
         current_chunk = ""
 
         for line in text.split("\n"):
+            # a single line can be longer than a whole message
+            while len(line) > max_length:
+                if current_chunk.strip():
+                    chunks.append(current_chunk.strip())
+                current_chunk = ""
+                chunks.append(line[:max_length])
+                line = line[max_length:]
             if len(current_chunk) + len(line) + 1 > max_length:
                 if current_chunk:
                     chunks.append(current_chunk.strip())
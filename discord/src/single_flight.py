@@ -0,0 +1,110 @@
+"""Coalescing of identical concurrent queries for Discord bot."""
+
+import asyncio
+import logging
+from collections.abc import AsyncIterator, Awaitable, Callable
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+Key = tuple[str, tuple[str, ...], bool]
+
+
+class SingleFlight:
+    """
+    Runs one agent request per distinct query at a time.
+
+    Concurrent duplicates await the first request's future instead of starting
+    their own, and finished answers are kept for result_ttl_seconds so that
+    repeats shortly after are answered without asking the agent again.
+    """
+
+    def __init__(self, result_ttl_seconds: int, maxsize: int = 1000):
+        self._in_flight: dict[Key, asyncio.Future[str]] = {}
+        self._results: TTLCache[Key, str] | None = (
+            TTLCache(maxsize=maxsize, ttl=result_ttl_seconds)
+            if result_ttl_seconds > 0
+            else None
+        )
+
+    @staticmethod
+    def key(query: str, roles: list[str], sources_only: bool) -> Key:
+        """Normalise a query so that trivially different spellings share a request."""
+        return " ".join(query.casefold().split()), tuple(sorted(roles)), sources_only
+
+    async def do(self, key: Key, fn: Callable[[], Awaitable[str]]) -> str:
+        """Return fn's result, sharing it with concurrent callers of the same key."""
+        if self._results is not None and key in self._results:
+            logger.info("Answering repeated query from recent results")
+            return self._results[key]
+
+        if key in self._in_flight:
+            logger.info("Joining identical in-flight query")
+            # shield so one caller giving up doesn't cancel the others
+            return await asyncio.shield(self._in_flight[key])
+
+        future = self._start(key)
+        try:
+            result = await fn()
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result=result)
+        return result
+
+    async def stream(
+        self, key: Key, fn: Callable[[], AsyncIterator[str]]
+    ) -> AsyncIterator[str]:
+        """
+        Yield fn's text deltas, sharing the result with concurrent callers.
+
+        The first caller streams as usual; duplicates receive the whole answer
+        as a single delta once it is complete.
+        """
+        if self._results is not None and key in self._results:
+            logger.info("Answering repeated query from recent results")
+            yield self._results[key]
+            return
+
+        if key in self._in_flight:
+            logger.info("Joining identical in-flight query")
+            yield await asyncio.shield(self._in_flight[key])
+            return
+
+        future = self._start(key)
+        text = ""
+        try:
+            async for delta in fn():
+                text += delta
+                yield delta
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result=text)
+
+    def _start(self, key: Key) -> asyncio.Future[str]:
+        future: asyncio.Future[str] = asyncio.get_running_loop().create_future()
+        # mark the exception retrieved, it's fine if nobody joined to see it
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._in_flight[key] = future
+        return future
+
+    def _finish(
+        self,
+        key: Key,
+        future: asyncio.Future[str],
+        result: str | None = None,
+        error: BaseException | None = None,
+    ):
+        self._in_flight.pop(key, None)
+        if error is not None:
+            # a cancelled or closed leader must not cancel the callers waiting on it
+            if not isinstance(error, Exception):
+                error = RuntimeError("Identical query was cancelled")
+            future.set_exception(error)
+            return
+
+        future.set_result(result or "")
+        # empty answers get the bot's fallback message; don't keep them
+        if result and self._results is not None:
+            self._results[key] = result
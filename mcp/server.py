@@ -1,11 +1,24 @@
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from fastmcp import FastMCP
 from fastmcp.server.dependencies import get_http_headers
+from cohere.core.api_error import ApiError
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+from psycopg.conninfo import make_conninfo
 from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+import asyncio
 import cohere
 import dotenv
+import httpx
 import psycopg
 import os
 import json
+import random
+import logging
+import time
+
+logger = logging.getLogger(__name__)
 
 # Load .env file if it exists (for local dev)
 dotenv.load_dotenv()
@@ -19,18 +32,210 @@ DB_PORT = int(os.environ.get("DB_PORT", "5432"))
 DB_NAME = os.environ.get("DB_NAME", "cavepediav2_db")
 DB_USER = os.environ.get("DB_USER", "cavepediav2_user")
 DB_PASSWORD = os.environ["DB_PASSWORD"]
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "20"))
+
+# Search config; ef_search trades recall for speed in the HNSW index built by the poller
+HNSW_EF_SEARCH = int(os.environ.get("HNSW_EF_SEARCH", "100"))
+# pgvector >= 0.8 only: keep scanning the index until enough rows pass the role filter
+HNSW_ITERATIVE_SCAN = os.environ.get("HNSW_ITERATIVE_SCAN", "")
+# hybrid: merge full-text and vector results with reciprocal-rank fusion; vector: vector results only
+SEARCH_MODE = os.environ.get("SEARCH_MODE", "hybrid")
+RRF_K = int(os.environ.get("RRF_K", "60"))
+# chunks fetched per candidate page, since several chunks of one page often match
+CHUNKS_PER_PAGE = int(os.environ.get("CHUNKS_PER_PAGE", "3"))
+
+# searches whose SQL takes longer than this many seconds have their query plan logged; 0 disables
+SLOW_QUERY_SECONDS = float(os.environ.get("SLOW_QUERY_SECONDS", "1.0"))
+
+# Query embedding cache config
+EMBED_CACHE_SIZE = int(os.environ.get("EMBED_CACHE_SIZE", "10000"))
+EMBED_CACHE_TTL = int(os.environ.get("EMBED_CACHE_TTL", str(30 * 24 * 60 * 60)))
+# also keep query embeddings in postgres, so they survive restarts and are shared between replicas
+EMBED_CACHE_PERSIST = os.environ.get("EMBED_CACHE_PERSIST", "false") == "true"
 
-co = cohere.ClientV2(COHERE_API_KEY)
-conn = psycopg.connect(
-    host=DB_HOST,
-    port=DB_PORT,
-    dbname=DB_NAME,
-    user=DB_USER,
-    password=DB_PASSWORD,
-    row_factory=dict_row,
+# Rerank config
+RERANK_CACHE_SIZE = int(os.environ.get("RERANK_CACHE_SIZE", "10000"))
+RERANK_CACHE_TTL = int(os.environ.get("RERANK_CACHE_TTL", str(24 * 60 * 60)))
+# skip reranking when the best candidate's cosine distance beats the runner-up by at least this much; 0 disables
+RERANK_SKIP_MARGIN = float(os.environ.get("RERANK_SKIP_MARGIN", "0"))
+
+# Cohere client config; size COHERE_CALLS_PER_MINUTE to our tier's rate limit for the rerank endpoint
+COHERE_CALLS_PER_MINUTE = float(os.environ.get("COHERE_CALLS_PER_MINUTE", "1000"))
+COHERE_MAX_RETRIES = int(os.environ.get("COHERE_MAX_RETRIES", "3"))
+# after this many failed calls in a row, stop calling Cohere for COHERE_BREAKER_SECONDS
+COHERE_BREAKER_FAILURES = int(os.environ.get("COHERE_BREAKER_FAILURES", "5"))
+COHERE_BREAKER_SECONDS = float(os.environ.get("COHERE_BREAKER_SECONDS", "30"))
+
+cohere_request_seconds = Histogram(
+    "mcp_cohere_request_seconds",
+    "Latency of each Cohere request, by call and outcome",
+    ["call", "outcome"],
 )
+cohere_retries_total = Counter("mcp_cohere_retries_total", "Cohere requests retried after a 429 or 5xx", ["call"])
+
+class TokenBucket:
+    """Allows rate calls per second on average, in bursts of up to burst calls."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        """Wait until a call is allowed."""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Cohere while the circuit breaker is open."""
+
+class CohereClient:
+    """Calls Cohere at up to COHERE_CALLS_PER_MINUTE, retrying rate limits and server errors with jittered
+    exponential backoff, and failing fast for COHERE_BREAKER_SECONDS after COHERE_BREAKER_FAILURES failed calls in a row."""
+
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(self, client):
+        self.client = client
+        self.bucket = TokenBucket(COHERE_CALLS_PER_MINUTE / 60, max(1.0, COHERE_CALLS_PER_MINUTE / 60))
+        self.failures = 0
+        self.opened_at = 0.0
+
+    async def embed(self, **kwargs):
+        return await self.call("embed", self.client.embed, **kwargs)
+
+    async def rerank(self, **kwargs):
+        return await self.call("rerank", self.client.rerank, **kwargs)
+
+    async def call(self, name, fn, **kwargs):
+        if self.failures >= COHERE_BREAKER_FAILURES and time.monotonic() - self.opened_at < COHERE_BREAKER_SECONDS:
+            raise CircuitOpenError(f"Cohere failed {self.failures} times in a row, not calling {name}")
 
-mcp = FastMCP("Cavepedia MCP")
+        for attempt in range(COHERE_MAX_RETRIES + 1):
+            await self.bucket.acquire()
+            start = time.monotonic()
+            try:
+                result = await fn(**kwargs)
+            except (ApiError, httpx.TransportError) as e:
+                cohere_request_seconds.labels(call=name, outcome="error").observe(time.monotonic() - start)
+                # connection errors and timeouts are retried like server errors
+                if isinstance(e, ApiError) and e.status_code not in self.RETRY_STATUS_CODES:
+                    raise
+                if attempt == COHERE_MAX_RETRIES:
+                    self.record_failure()
+                    raise
+                cohere_retries_total.labels(call=name).inc()
+                # full jitter, and capped low since a user is waiting on the search
+                await asyncio.sleep(random.uniform(0, min(10, 0.5 * 2**attempt)))
+                continue
+            cohere_request_seconds.labels(call=name, outcome="ok").observe(time.monotonic() - start)
+            self.failures = 0
+            return result
+        raise AssertionError("unreachable")
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= COHERE_BREAKER_FAILURES:
+            logger.error(f"Cohere failed {self.failures} times in a row, pausing calls for {COHERE_BREAKER_SECONDS}s")
+            self.opened_at = time.monotonic()
+
+co = CohereClient(cohere.AsyncClientV2(COHERE_API_KEY))
+# autocommit, so searches never leave a connection idle in a transaction.
+# connections are checked before being handed out, and the pool reconnects in the background if the db goes away.
+pool = AsyncConnectionPool(
+    make_conninfo(host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD),
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    kwargs={"row_factory": dict_row, "autocommit": True},
+    check=AsyncConnectionPool.check_connection,
+    reconnect_failed=lambda pool: logger.error("Could not reconnect to the database"),
+    open=False,
+)
+
+@asynccontextmanager
+async def lifespan(server):
+    await pool.open()
+    if EMBED_CACHE_PERSIST:
+        await create_query_embeddings_table()
+    try:
+        yield
+    finally:
+        await pool.close()
+
+mcp = FastMCP("Cavepedia MCP", lifespan=lifespan)
+
+class LRUCache:
+    """In-memory LRU cache whose entries also expire after ttl seconds."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+embedding_cache = LRUCache(EMBED_CACHE_SIZE, EMBED_CACHE_TTL)
+# background writes to the persistent cache; referenced here so they aren't garbage collected mid-flight
+background_tasks: set[asyncio.Task] = set()
+
+rerank_cache = LRUCache(RERANK_CACHE_SIZE, RERANK_CACHE_TTL)
+rerank_total = Counter(
+    "mcp_rerank_total",
+    "Searches by how their candidates were ranked: reranked by Cohere, from the rerank cache, or skipped",
+    ["path"],
+)
+
+search_phase_seconds = Histogram(
+    "mcp_search_phase_seconds",
+    "Time spent in each phase of a search, by the caller's role count and the number of candidates",
+    ["phase", "roles", "candidates"],
+)
+
+def count_label(count: int, cap: int) -> str:
+    """Bucket a count for a metric label, so labels stay few."""
+    return str(count) if count < cap else f"{cap}+"
+
+def observe_phases(phases: dict[str, float], roles: int, candidates: int):
+    labels = {"roles": count_label(roles, 5), "candidates": count_label(candidates, 10)}
+    for phase, seconds in phases.items():
+        search_phase_seconds.labels(phase=phase, **labels).observe(seconds)
+
+async def create_query_embeddings_table():
+    async with pool.connection() as conn:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS query_embeddings (
+                query TEXT PRIMARY KEY,
+                embedding REAL[],
+                created_at TIMESTAMPTZ DEFAULT now()
+            )
+        """)
+        await conn.execute("CREATE INDEX IF NOT EXISTS query_embeddings_created_at_idx ON query_embeddings (created_at)")
 
 def get_user_roles() -> list[str]:
     """Extract user roles from the X-User-Roles header."""
@@ -48,8 +253,8 @@ def is_sources_only() -> bool:
     headers = get_http_headers()
     return headers.get("x-sources-only", "false") == "true"
 
-def embed(text, input_type):
-    resp = co.embed(
+async def embed(text, input_type):
+    resp = await co.embed(
         texts=[text],
         model='embed-v4.0',
         input_type=input_type,
@@ -58,8 +263,61 @@ def embed(text, input_type):
     assert resp.embeddings.float_ is not None
     return resp.embeddings.float_[0]
 
+def normalize_query(query: str) -> str:
+    """Normalize a query so trivially different phrasings share cache entries."""
+    return " ".join(query.lower().split())
+
+async def embed_query(query: str):
+    """Embed a search query, using the in-memory cache and then the persistent cache before calling Cohere."""
+    key = normalize_query(query)
+    embedding = embedding_cache.get(key)
+    if embedding is not None:
+        return embedding
+
+    if EMBED_CACHE_PERSIST:
+        async with pool.connection() as conn:
+            cur = await conn.execute(
+                'SELECT embedding FROM query_embeddings WHERE query = %s AND created_at > now() - make_interval(secs => %s)',
+                (key, EMBED_CACHE_TTL),
+            )
+            row = await cur.fetchone()
+        if row is not None:
+            embedding_cache.set(key, row['embedding'])
+            return row['embedding']
+
+    # the key only groups cache entries; embed the query as written, since case can matter (SRT, NSS)
+    embedding = await embed(query, 'search_query')
+    embedding_cache.set(key, embedding)
+    if EMBED_CACHE_PERSIST:
+        task = asyncio.create_task(store_query_embedding(key, embedding))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+    return embedding
+
+async def store_query_embedding(key: str, embedding):
+    """Persist a query embedding, evicting expired entries and the oldest entries past EMBED_CACHE_SIZE."""
+    try:
+        async with pool.connection() as conn, conn.transaction():
+            await conn.execute(
+                'INSERT INTO query_embeddings (query, embedding) VALUES (%s, %s) '
+                'ON CONFLICT (query) DO UPDATE SET embedding = EXCLUDED.embedding, created_at = now()',
+                (key, embedding),
+            )
+            await conn.execute(
+                'DELETE FROM query_embeddings WHERE created_at < now() - make_interval(secs => %s)',
+                (EMBED_CACHE_TTL,),
+            )
+            await conn.execute(
+                'DELETE FROM query_embeddings WHERE query IN '
+                '(SELECT query FROM query_embeddings ORDER BY created_at DESC OFFSET %s)',
+                (EMBED_CACHE_SIZE,),
+            )
+    except psycopg.Error as e:
+        # the cache is an optimisation; never fail a search because of it
+        logger.warning(f"Failed to persist query embedding: {e}")
+
 @mcp.tool
-def search_caving_documents(query: str, priority_prefixes: list[str] | None = None) -> dict:
+async def search_caving_documents(query: str, priority_prefixes: list[str] | None = None) -> dict:
     """Search caving documents for information about caves, techniques, safety, accidents, history, and more.
 
     Args:
@@ -70,34 +328,40 @@ def search_caving_documents(query: str, priority_prefixes: list[str] | None = No
     if not roles:
         return {"results": [], "note": "No results. Answer based on your knowledge."}
 
-    query_embedding = embed(query, 'search_query')
+    phases = {}
+    start = time.monotonic()
+    query_embedding = await embed_query(query)
+    phases['embed'] = time.monotonic() - start
 
     # Fetch more candidates for reranking
     top_n = 2
     candidate_limit = top_n * 4
-    rows = conn.execute(
-        'SELECT * FROM embeddings WHERE embedding IS NOT NULL AND LENGTH(content) > 100 AND role = ANY(%s) ORDER BY embedding <=> %s::vector LIMIT %s',
-        (roles, query_embedding, candidate_limit)
-    ).fetchall()
+    start = time.monotonic()
+    if SEARCH_MODE == "hybrid":
+        vector_rows, lexical_rows = await asyncio.gather(
+            vector_search(query_embedding, roles, candidate_limit),
+            lexical_search(query, query_embedding, roles, candidate_limit),
+        )
+        rows = fuse(vector_rows, lexical_rows)[:candidate_limit]
+    else:
+        rows = await vector_search(query_embedding, roles, candidate_limit)
+    phases['sql'] = time.monotonic() - start
 
     if not rows:
+        observe_phases(phases, len(roles), 0)
         return {"results": [], "note": "No results found. Answer based on your knowledge."}
 
-    # Rerank with Cohere for better relevance
-    rerank_resp = co.rerank(
-        query=query,
-        documents=[row['content'] or '' for row in rows],
-        model='rerank-v3.5',
-        top_n=min(top_n * 2, len(rows)),
-    )
+    start = time.monotonic()
+    ranked = await rank(query, rows, min(top_n * 2, len(rows)))
+    phases['rerank'] = time.monotonic() - start
 
     # Build results with optional priority boost
+    start = time.monotonic()
     docs = []
     sources_only = is_sources_only()
-    for result in rerank_resp.results:
-        row = rows[result.index]
-        content = row['content'] or ''
-        score = result.relevance_score
+    for index, score in ranked:
+        row = rows[index]
+        content = row['page_content'] or ''
 
         # Boost score if key starts with any priority prefix (e.g., 'nss/aca')
         if priority_prefixes:
@@ -112,27 +376,169 @@ def search_caving_documents(query: str, priority_prefixes: list[str] | None = No
 
     # Re-sort by boosted score and return top_n
     docs.sort(key=lambda x: x['relevance'], reverse=True)
+    phases['post'] = time.monotonic() - start
+    observe_phases(phases, len(roles), len(rows))
     return {
         "results": docs[:top_n],
         "note": "These are ALL available results. Do NOT search again - answer using these results now."
     }
 
+# Searches match chunks of pages; each row is the page's best chunk, with id, key and page_content from the page
+CHUNK_COLUMNS = 'e.id, e.key, e.content AS page_content, c.content, c.distance'
+
+VECTOR_SEARCH_SQL = (
+    f'SELECT {CHUNK_COLUMNS} FROM ('
+    '(SELECT page_id, content, embedding <=> %(embedding)s::vector AS distance FROM chunks '
+    'WHERE embedding IS NOT NULL AND role = ANY(%(roles)s) ORDER BY distance LIMIT %(limit)s) '
+    # pages embedded whole before chunking keep their page vector until their chunks are embedded
+    'UNION ALL '
+    '(SELECT id, content, embedding <=> %(embedding)s::vector AS distance FROM embeddings '
+    'WHERE embedding IS NOT NULL AND role = ANY(%(roles)s) ORDER BY distance LIMIT %(limit)s)'
+    ') c JOIN embeddings e ON e.id = c.page_id ORDER BY c.distance'
+)
+
+# the vector distance is only computed for the best full-text matches, not every chunk containing a common word
+LEXICAL_SEARCH_SQL = (
+    'SELECT e.id, e.key, e.content AS page_content, c.content, c.embedding <=> %s::vector AS distance FROM ('
+    'SELECT page_id, content, embedding, ts_rank_cd(content_tsv, q) AS rank '
+    'FROM chunks, websearch_to_tsquery(%s, %s) AS q '
+    'WHERE content_tsv @@ q AND embedding IS NOT NULL AND role = ANY(%s) ORDER BY rank DESC LIMIT %s'
+    ') c JOIN embeddings e ON e.id = c.page_id ORDER BY c.rank DESC'
+)
+
+async def vector_search(query_embedding, roles: list[str], limit: int):
+    """Pages with the nearest chunks to the query embedding, closest first."""
+    rows = await search_query(
+        'vector',
+        VECTOR_SEARCH_SQL,
+        {'embedding': query_embedding, 'roles': roles, 'limit': limit * CHUNKS_PER_PAGE},
+    )
+    return collapse(rows)[:limit]
+
+async def lexical_search(query: str, query_embedding, roles: list[str], limit: int):
+    """Pages with chunks matching the query's words, best full-text match first."""
+    rows = await search_query(
+        'lexical', LEXICAL_SEARCH_SQL, (query_embedding, 'english', query, roles, limit * CHUNKS_PER_PAGE)
+    )
+    return collapse(rows)[:limit]
+
+async def set_search_config(conn):
+    """Apply the HNSW search settings for the rest of the current transaction."""
+    await conn.execute("SELECT set_config('hnsw.ef_search', %s, true)", (str(HNSW_EF_SEARCH),))
+    if HNSW_ITERATIVE_SCAN:
+        await conn.execute("SELECT set_config('hnsw.iterative_scan', %s, true)", (HNSW_ITERATIVE_SCAN,))
+
+async def search_query(name: str, query: str, params: tuple | dict) -> list:
+    """Run a search query, logging its plan in the background if it is slower than SLOW_QUERY_SECONDS."""
+    start = time.monotonic()
+    async with pool.connection() as conn, conn.transaction():
+        await set_search_config(conn)
+        cur = await conn.execute(query, params)
+        rows = await cur.fetchall()
+    elapsed = time.monotonic() - start
+    if SLOW_QUERY_SECONDS > 0 and elapsed > SLOW_QUERY_SECONDS:
+        task = asyncio.create_task(log_query_plan(name, query, params, elapsed))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+    return rows
+
+async def log_query_plan(name: str, query: str, params: tuple | dict, elapsed: float):
+    """Log the plan of a slow search query, with the same settings it ran with."""
+    try:
+        async with pool.connection() as conn, conn.transaction():
+            await set_search_config(conn)
+            cur = await conn.execute('EXPLAIN ' + query, params)
+            plan = '\n'.join(row['QUERY PLAN'] for row in await cur.fetchall())
+        logger.warning(f"Slow {name} search query took {elapsed:.2f}s, plan:\n{plan}")
+    except psycopg.Error as e:
+        logger.warning(f"Slow {name} search query took {elapsed:.2f}s, failed to explain it: {e}")
+
+def collapse(rows) -> list:
+    """Keep only the first (best) chunk of each page."""
+    pages: dict = {}
+    for row in rows:
+        pages.setdefault(row['id'], row)
+    return list(pages.values())
+
+def fuse(*results) -> list:
+    """Merge ranked result lists with reciprocal-rank fusion, best first."""
+    scores: dict = {}
+    rows: dict = {}
+    for result in results:
+        for rank, row in enumerate(result):
+            scores[row['id']] = scores.get(row['id'], 0) + 1 / (RRF_K + rank + 1)
+            rows[row['id']] = row
+    return [rows[id] for id in sorted(scores, key=lambda id: scores[id], reverse=True)]
+
+async def rank(query: str, rows, top_n: int) -> list[tuple[int, float]]:
+    """Rank candidate rows, returning (row index, relevance) pairs, best first.
+
+    Uses the vector distances when the top candidate is also the nearest by a clear margin, otherwise Cohere
+    rerank (cached by query and candidate ids), falling back to the retrieval order if Cohere fails.
+    """
+    by_distance = sorted(range(len(rows)), key=lambda i: rows[i]['distance'])
+    if RERANK_SKIP_MARGIN > 0 and by_distance[0] == 0 and (
+        len(rows) == 1 or rows[by_distance[1]]['distance'] - rows[0]['distance'] >= RERANK_SKIP_MARGIN
+    ):
+        rerank_total.labels(path="skipped").inc()
+        return [(i, 1 - rows[i]['distance']) for i in by_distance[:top_n]]
+
+    key = (normalize_query(query), tuple(row['id'] for row in rows), top_n)
+    ranked = rerank_cache.get(key)
+    if ranked is not None:
+        rerank_total.labels(path="cached").inc()
+        return ranked
+
+    # Rerank with Cohere for better relevance; if Cohere is down, fall back to the retrieval order
+    try:
+        rerank_resp = await co.rerank(
+            query=query,
+            documents=[row['content'] or '' for row in rows],
+            model='rerank-v3.5',
+            top_n=top_n,
+        )
+    except (ApiError, httpx.TransportError, CircuitOpenError) as e:
+        logger.warning(f"Rerank failed, using retrieval order: {e}")
+        rerank_total.labels(path="failed").inc()
+        return [(i, 1 - rows[i]['distance']) for i in range(min(top_n, len(rows)))]
+    ranked = [(result.index, result.relevance_score) for result in rerank_resp.results]
+    rerank_cache.set(key, ranked)
+    rerank_total.labels(path="reranked").inc()
+    return ranked
+
 @mcp.tool
-def get_user_info() -> dict:
+async def get_user_info() -> dict:
     """Get information about the current user's roles."""
     roles = get_user_roles()
     return {
         "roles": roles,
     }
 
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, Response
 from starlette.routing import Route
 
+async def corpus_version() -> str | None:
+    """Changes whenever chunks are added, re-embedded or removed, so clients can tell when cached answers are stale."""
+    try:
+        async with pool.connection(timeout=2) as conn:
+            cur = await conn.execute(
+                "SELECT n_tup_ins + n_tup_upd + n_tup_del AS version FROM pg_stat_user_tables WHERE relname = 'chunks'"
+            )
+            row = await cur.fetchone()
+    except (psycopg.Error, PoolTimeout) as e:
+        logger.warning(f"Failed to get the corpus version: {e}")
+        return None
+    return str(row['version']) if row else None
+
 async def health(request):
-    return JSONResponse({"status": "ok"})
+    return JSONResponse({"status": "ok", "corpus_version": await corpus_version()})
+
+async def metrics(request):
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 app = mcp.http_app()
 app.routes.append(Route("/health", health))
+app.routes.append(Route("/metrics", metrics))
 
 if __name__ == "__main__":
     mcp.run(transport='http', host='::1', port=9031)
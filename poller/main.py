@@ -1,16 +1,35 @@
+import gzip
+import hashlib
 import io
+import json
 import logging
+import math
+import multiprocessing
 import os
+import random
+import re
+import tempfile
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from datetime import UTC, datetime
 from urllib.parse import unquote
 
 import anthropic
 import boto3
 import cohere
 import dotenv
+import httpx
 import psycopg
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError
 from cohere.core.api_error import ApiError
 from pgvector.psycopg import register_vector
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from psycopg import sql
+from psycopg.pq import TransactionStatus
 from psycopg.rows import dict_row
 from pypdf import PdfReader, PdfWriter
 from pythonjsonlogger.json import JsonFormatter
@@ -41,27 +60,232 @@ DB_NAME = os.environ.get("DB_NAME", "cavepediav2_db")
 DB_USER = os.environ.get("DB_USER", "cavepediav2_user")
 DB_PASSWORD = os.environ["DB_PASSWORD"]
 
+# Cohere client config; size COHERE_CALLS_PER_MINUTE to our tier's rate limit for the embed endpoint
+COHERE_CALLS_PER_MINUTE = float(os.environ.get("COHERE_CALLS_PER_MINUTE", "2000"))
+COHERE_MAX_RETRIES = int(os.environ.get("COHERE_MAX_RETRIES", "5"))
+# after this many failed calls in a row, stop calling cohere for COHERE_BREAKER_SECONDS
+COHERE_BREAKER_FAILURES = int(os.environ.get("COHERE_BREAKER_FAILURES", "5"))
+COHERE_BREAKER_SECONDS = float(os.environ.get("COHERE_BREAKER_SECONDS", "60"))
+
+# Embedding config; cohere accepts at most 96 texts per embed request
+EMBED_BATCH_SIZE = min(int(os.environ.get("EMBED_BATCH_SIZE", "96")), 96)
+EMBED_CONCURRENCY = int(os.environ.get("EMBED_CONCURRENCY", "4"))
+
+# OCR batch scheduling config
+OCR_BATCH_SIZE_MAX = int(os.environ.get("OCR_BATCH_SIZE_MAX", "1000"))
+OCR_BATCH_SIZE_MIN = int(os.environ.get("OCR_BATCH_SIZE_MIN", "100"))
+OCR_MAX_BATCHES_IN_FLIGHT = int(os.environ.get("OCR_MAX_BATCHES_IN_FLIGHT", "4"))
+OCR_MAX_BATCHES_PER_CYCLE = int(os.environ.get("OCR_MAX_BATCHES_PER_CYCLE", "2"))
+# claude tokens to spend per cycle; a single pdf page is up to 2k tokens
+OCR_TOKEN_BUDGET = int(os.environ.get("OCR_TOKEN_BUDGET", "4000000"))
+OCR_TOKENS_PER_PAGE = 2000
+# files that fail to split this many times are skipped until they are uploaded again
+SPLIT_MAX_ATTEMPTS = int(os.environ.get("SPLIT_MAX_ATTEMPTS", "3"))
+# pages whose OCR fails this many times are marked as errored instead of being re-queued
+OCR_MAX_ATTEMPTS = int(os.environ.get("OCR_MAX_ATTEMPTS", "3"))
+# pages sent to claude that haven't come back in this long are re-queued; batches take up to 24 hours
+OCR_TIMEOUT_HOURS = float(os.environ.get("OCR_TIMEOUT_HOURS", "48"))
+# claude fetches every page in a batch from the file server; back off when it's slow to respond
+OCR_S3_SLOW_SECONDS = float(os.environ.get("OCR_S3_SLOW_SECONDS", "1.0"))
+# born-digital pages with a good enough text layer skip claude; set TEXT_LAYER_MIN_SCORE above 1 to OCR every page
+TEXT_LAYER_MIN_CHARS = int(os.environ.get("TEXT_LAYER_MIN_CHARS", "200"))
+TEXT_LAYER_MIN_SCORE = float(os.environ.get("TEXT_LAYER_MIN_SCORE", "0.8"))
+
+# Chunking config; pages are split into overlapping windows of CHUNK_SIZE words (roughly 1.3 tokens each)
+CHUNK_SIZE = int(os.environ.get("CHUNK_SIZE", "300"))
+CHUNK_OVERLAP = int(os.environ.get("CHUNK_OVERLAP", "50"))
+# pages with less content than this are not chunked, and so never searched
+MIN_CONTENT_LENGTH = 100
+
+# Splitting config
+SPLIT_PROCESSES = int(os.environ.get("SPLIT_PROCESSES", str(os.cpu_count() or 1)))
+S3_WORKERS = int(os.environ.get("S3_WORKERS", "8"))
+
+# Scheduling config
+# serial: run every stage in turn, then sleep POLL_INTERVAL
+# workers: run each stage in its own thread on its own interval (<STAGE>_INTERVAL, in seconds)
+POLLER_MODE = os.environ.get("POLLER_MODE", "serial")
+POLL_INTERVAL = int(os.environ.get("POLL_INTERVAL", "300"))
+
+# Event config; minio writes bucket notifications to this table, and a trigger on it notifies IMPORT_CHANNEL
+MINIO_EVENTS_TABLE = os.environ.get("MINIO_EVENTS_TABLE", "events")
+IMPORT_CHANNEL = "cavepediav2_import"
+
+# Search index config; see https://github.com/pgvector/pgvector#hnsw
+HNSW_M = int(os.environ.get("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.environ.get("HNSW_EF_CONSTRUCTION", "64"))
+
+# Metrics config; prometheus metrics are served on this port, 0 disables them
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100"))
+
 s3 = boto3.client(
     "s3",
     aws_access_key_id=S3_ACCESS_KEY,
     aws_secret_access_key=S3_SECRET_KEY,
     endpoint_url=S3_ENDPOINT,
     region_name=S3_REGION,
+    config=BotoConfig(max_pool_connections=max(10, S3_WORKERS)),
 )
-co = cohere.ClientV2(api_key=COHERE_API_KEY)
-conn = psycopg.connect(
-    host=DB_HOST,
-    port=DB_PORT,
-    dbname=DB_NAME,
-    user=DB_USER,
-    password=DB_PASSWORD,
-    row_factory=dict_row,
+
+# minutes-long stages and batches need wider buckets than prometheus' defaults
+LONG_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 3 * 3600, 6 * 3600, 12 * 3600, 24 * 3600)
+stage_seconds = Histogram("poller_stage_seconds", "Time each run of a stage took", ["stage"], buckets=LONG_BUCKETS)
+ocr_submit_seconds = Histogram("poller_ocr_submit_seconds", "Time to create a claude OCR batch", buckets=LONG_BUCKETS)
+ocr_apply_seconds = Histogram("poller_ocr_apply_seconds", "Time to apply a finished OCR batch", buckets=LONG_BUCKETS)
+ocr_batch_age_seconds = Histogram(
+    "poller_ocr_batch_age_seconds", "Age of OCR batches when their results are applied", buckets=LONG_BUCKETS
+)
+ocr_oldest_batch_seconds = Gauge("poller_ocr_oldest_batch_seconds", "Age of the oldest unfinished OCR batch")
+ocr_batches_in_flight = Gauge("poller_ocr_batches_in_flight", "Unfinished OCR batches")
+pages_total = Counter("poller_pages_total", "Pages processed, by stage", ["stage"])
+chunks_embedded_total = Counter("poller_chunks_embedded_total", "Chunks embedded")
+pages_by_status = Gauge("poller_pages_by_status", "Pages in each status", ["status"])
+chunks_unembedded = Gauge("poller_chunks_unembedded", "Chunks waiting to be embedded")
+files_unsplit = Gauge("poller_files_unsplit", "Imported files waiting to be split")
+files_failed = Gauge("poller_files_failed", "Imported files that failed to split SPLIT_MAX_ATTEMPTS times")
+cohere_request_seconds = Histogram(
+    "poller_cohere_request_seconds", "Latency of each cohere request", ["call", "outcome"]
 )
+cohere_retries_total = Counter("poller_cohere_retries_total", "Cohere requests retried after a 429 or 5xx", ["call"])
+
+
+class TokenBucket:
+    """Allows rate calls per second on average, in bursts of up to burst calls"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a call is allowed"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling cohere while the circuit breaker is open"""
+
+
+class CohereClient:
+    """Calls cohere at up to COHERE_CALLS_PER_MINUTE, retrying rate limits and server errors with jittered exponential
+    backoff, and failing fast for COHERE_BREAKER_SECONDS after COHERE_BREAKER_FAILURES failed calls in a row"""
+
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(self, client):
+        self.client = client
+        self.bucket = TokenBucket(COHERE_CALLS_PER_MINUTE / 60, max(1.0, COHERE_CALLS_PER_MINUTE / 60))
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def embed(self, **kwargs):
+        return self.call("embed", self.client.embed, **kwargs)
+
+    def call(self, name, fn, **kwargs):
+        with self.lock:
+            if self.failures >= COHERE_BREAKER_FAILURES and time.monotonic() - self.opened_at < COHERE_BREAKER_SECONDS:
+                raise CircuitOpenError(f"cohere failed {self.failures} times in a row, not calling {name}")
+
+        for attempt in range(COHERE_MAX_RETRIES + 1):
+            self.bucket.acquire()
+            start = time.monotonic()
+            try:
+                result = fn(**kwargs)
+            except (ApiError, httpx.TransportError) as e:
+                cohere_request_seconds.labels(call=name, outcome="error").observe(time.monotonic() - start)
+                # connection errors and timeouts are retried like server errors
+                reason = e.status_code if isinstance(e, ApiError) else type(e).__name__
+                logger.warning(f"cohere {name} failed after {time.monotonic() - start:.2f}s: {reason}")
+                if isinstance(e, ApiError) and e.status_code not in self.RETRY_STATUS_CODES:
+                    raise
+                if attempt == COHERE_MAX_RETRIES:
+                    self.record_failure()
+                    raise
+                cohere_retries_total.labels(call=name).inc()
+                # full jitter, so threads that were throttled together don't retry together
+                time.sleep(random.uniform(0, min(60, 2**attempt)))
+                continue
+            cohere_request_seconds.labels(call=name, outcome="ok").observe(time.monotonic() - start)
+            with self.lock:
+                self.failures = 0
+            return result
+        raise AssertionError("unreachable")
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= COHERE_BREAKER_FAILURES:
+                logger.error(f"cohere failed {self.failures} times in a row, pausing for {COHERE_BREAKER_SECONDS}s")
+                self.opened_at = time.monotonic()
+
+
+co = CohereClient(cohere.ClientV2(api_key=COHERE_API_KEY))
+
+_local = threading.local()
+
+
+def connect(autocommit=False):
+    return psycopg.connect(
+        host=DB_HOST,
+        port=DB_PORT,
+        dbname=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        row_factory=dict_row,
+        autocommit=autocommit,
+    )
+
+
+def get_conn():
+    """Get this thread's database connection, so stages running in different threads never share a transaction"""
+    conn = getattr(_local, "conn", None)
+    if conn is None or conn.closed:
+        conn = connect()
+        if conn.execute("SELECT 1 FROM pg_extension WHERE extname = 'vector'").fetchone():
+            register_vector(conn)
+        conn.commit()
+        _local.conn = conn
+    return conn
+
+
+@contextmanager
+def advisory_lock(name):
+    """Run a stage on at most one poller replica at a time; yields False if another replica holds the lock"""
+    conn = get_conn()
+    row = conn.execute("SELECT pg_try_advisory_lock(hashtext(%s)) AS locked", (name,)).fetchone()
+    conn.commit()
+    assert row is not None
+    try:
+        yield row["locked"]
+    except BaseException:
+        # don't let the unlock below commit a stage's half done work
+        if conn.info.transaction_status != TransactionStatus.IDLE:
+            conn.rollback()
+        raise
+    finally:
+        if row["locked"]:
+            if conn.info.transaction_status == TransactionStatus.INERROR:
+                conn.rollback()
+            conn.execute("SELECT pg_advisory_unlock(hashtext(%s))", (name,))
+            conn.commit()
 
 
 ## init
 # events table is created by minio up creation of event destination
 def create_tables():
+    conn = get_conn()
     commands = (
         """
         CREATE TABLE IF NOT EXISTS metadata (
@@ -81,6 +305,7 @@ def create_tables():
             done BOOLEAN DEFAULT FALSE
         )
         """,
+        "ALTER TABLE batches ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ DEFAULT now()",
         "CREATE EXTENSION IF NOT EXISTS vector",
         """
         CREATE TABLE IF NOT EXISTS embeddings (
@@ -93,79 +318,559 @@ def create_tables():
             UNIQUE(bucket, key)
         )
         """,
+        # where each page is in the pipeline: pending -> ocr -> ocred -> chunked (or empty, or error)
+        """
+        DO $$ BEGIN
+            CREATE TYPE page_status AS ENUM ('pending', 'ocr', 'ocred', 'chunked', 'empty', 'error');
+        EXCEPTION WHEN duplicate_object THEN NULL;
+        END $$
+        """,
+        "ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS status page_status NOT NULL DEFAULT 'pending'",
+        "ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS status_at TIMESTAMPTZ NOT NULL DEFAULT now()",
+        "ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now()",
+        "ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS attempts INTEGER DEFAULT 0",
+        # hashes let identical files, pages and OCR text reuse earlier work instead of going back to claude and cohere
+        "ALTER TABLE metadata ADD COLUMN IF NOT EXISTS sha256 TEXT",
+        # published in the file manifest; updated_at lets the manifest tell whether anything changed
+        "ALTER TABLE metadata ADD COLUMN IF NOT EXISTS size BIGINT",
+        "ALTER TABLE metadata ADD COLUMN IF NOT EXISTS pages INTEGER",
+        "ALTER TABLE metadata ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ",
+        # files that fail to split (a corrupt pdf, an s3 error) are retried, then skipped so they don't block the rest
+        "ALTER TABLE metadata ADD COLUMN IF NOT EXISTS split_attempts INTEGER DEFAULT 0",
+        "ALTER TABLE metadata ADD COLUMN IF NOT EXISTS split_error TEXT",
+        """
+        CREATE TABLE IF NOT EXISTS manifests (
+            key TEXT PRIMARY KEY,
+            version TEXT,
+            etag TEXT
+        )
+        """,
+        "ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS page_sha256 TEXT",
+        "ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS content_sha256 TEXT",
+        # search works on chunks of pages; the page level search indexes and columns are no longer used
+        "DROP INDEX IF EXISTS embeddings_embedding_hnsw_idx",
+        "DROP INDEX IF EXISTS embeddings_content_tsv_idx",
+        "DROP INDEX IF EXISTS embeddings_role_idx",
+        "ALTER TABLE embeddings DROP COLUMN IF EXISTS content_tsv",
+        # content_tsv is for lexical search of exact tokens (cave names, survey ids, counties) that embeddings miss
+        """
+        CREATE TABLE IF NOT EXISTS chunks (
+            id SERIAL PRIMARY KEY,
+            page_id INTEGER REFERENCES embeddings(id) ON DELETE CASCADE,
+            chunk_index INTEGER,
+            role TEXT,
+            content TEXT,
+            embedding vector(1536),
+            content_tsv tsvector GENERATED ALWAYS AS (to_tsvector('english', coalesce(content, ''))) STORED,
+            UNIQUE(page_id, chunk_index)
+        )
+        """,
     )
+    # pages from before the status column have their state in content instead, see migrate_page_status
+    had_status = column_exists(conn, "embeddings", "status")
     for command in commands:
         conn.execute(command)
+    if not had_status:
+        migrate_page_status(conn)
     conn.commit()
     register_vector(conn)
+    create_indexes()
+    create_event_trigger()
+
+
+def column_exists(conn, table, column):
+    row = conn.execute(
+        """
+        SELECT EXISTS (
+            SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = %s
+        ) AS found
+        """,
+        (table, column),
+    ).fetchone()
+    assert row is not None
+    return row["found"]
+
+
+def migrate_page_status(conn):
+    """Move pages from the old content sentinels (NULL, 'WIP', 'ERROR') and chunked flag to the status column"""
+    logger.info("Migrating pages to the status column.")
+    # pages OCR'd before chunking existed have no chunked flag; mark them ocred so the chunk stage backfills them
+    if column_exists(conn, "embeddings", "chunked"):
+        done = "WHEN NOT chunked THEN 'ocred' WHEN LENGTH(content) > %s THEN 'chunked' ELSE 'empty'"
+        params: tuple = (MIN_CONTENT_LENGTH,)
+    else:
+        done = "ELSE 'ocred'"
+        params = ()
+    conn.execute(
+        sql.SQL(
+            """
+            UPDATE embeddings SET
+                status = CASE
+                    WHEN content IS NULL THEN 'pending'
+                    WHEN content = 'WIP' THEN 'ocr'
+                    WHEN content = 'ERROR' THEN 'error'
+                    {}
+                END::page_status,
+                content = CASE WHEN content IN ('WIP', 'ERROR') THEN NULL ELSE content END
+            """
+        ).format(sql.SQL(done)),
+        params,
+    )
+    conn.execute("ALTER TABLE embeddings DROP COLUMN IF EXISTS chunked")
+
+
+def create_indexes():
+    """Create the indexes used by search, rebuilding the ANN index if its build parameters changed"""
+    # replicas starting together would otherwise race to drop and build the same indexes
+    with advisory_lock("create_indexes") as locked:
+        if not locked:
+            logger.info("Another poller is creating indexes, skipping.")
+            return
+        _create_indexes()
+
+
+def _create_indexes():
+    HNSW_INDEX = "chunks_embedding_hnsw_idx"
+    options = [f"m={HNSW_M}", f"ef_construction={HNSW_EF_CONSTRUCTION}"]
+
+    # build concurrently so other pollers and searches aren't blocked; this can't run inside a transaction
+    with connect(autocommit=True) as conn:
+        row = conn.execute(
+            """
+            SELECT c.reloptions, i.indisvalid FROM pg_class c
+            JOIN pg_index i ON i.indexrelid = c.oid
+            WHERE c.relname = %s
+            """,
+            (HNSW_INDEX,),
+        ).fetchone()
+        if row is not None and (not row["indisvalid"] or sorted(row["reloptions"] or []) != sorted(options)):
+            logger.info(f"Dropping index {HNSW_INDEX} to rebuild it with {options}")
+            conn.execute(sql.SQL("DROP INDEX CONCURRENTLY {}").format(sql.Identifier(HNSW_INDEX)))
+            row = None
+        if row is None:
+            logger.info(f"Building index {HNSW_INDEX} with {options}")
+            conn.execute(
+                sql.SQL(
+                    """
+                    CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON chunks
+                    USING hnsw (embedding vector_cosine_ops) WITH (m = {}, ef_construction = {})
+                    """
+                ).format(sql.Identifier(HNSW_INDEX), sql.Literal(HNSW_M), sql.Literal(HNSW_EF_CONSTRUCTION))
+            )
+
+        conn.execute(
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS chunks_content_tsv_idx ON chunks USING gin (content_tsv)
+            WHERE embedding IS NOT NULL
+            """
+        )
+
+        conn.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS embeddings_page_sha256_idx ON embeddings (page_sha256)")
+        conn.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS embeddings_content_sha256_idx ON embeddings (content_sha256)"
+        )
+
+        # each stage finds its work with a small partial index instead of scanning every page or chunk
+        for index, table, columns, where in (
+            ("embeddings_pending_idx", "embeddings", "id", "status = 'pending'"),
+            ("embeddings_ocr_idx", "embeddings", "status_at", "status = 'ocr'"),
+            ("embeddings_ocred_idx", "embeddings", "id", "status = 'ocred'"),
+            ("chunks_unembedded_idx", "chunks", "id", "embedding IS NULL"),
+            # pages embedded whole, from before chunking, are searched by their page vector until their chunks are
+            ("embeddings_page_vector_idx", "embeddings", "id", "embedding IS NOT NULL"),
+        ):
+            conn.execute(
+                sql.SQL("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} ({}) WHERE {}").format(
+                    sql.Identifier(index), sql.Identifier(table), sql.Identifier(columns), sql.SQL(where)
+                )
+            )
+
+        # lets the planner do an exact scan for roles with few pages, where filtering the ANN scan finds too few rows
+        conn.execute(
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS chunks_role_idx ON chunks (role)
+            WHERE embedding IS NOT NULL
+            """
+        )
+
+
+def create_event_trigger():
+    """Notify IMPORT_CHANNEL whenever minio records an event for the import bucket"""
+    conn = get_conn()
+    row = conn.execute("SELECT to_regclass(%s) AS events", (MINIO_EVENTS_TABLE,)).fetchone()
+    assert row is not None
+    if row["events"] is None:
+        logger.info(f"No minio events table {MINIO_EVENTS_TABLE}, imports will be polled.")
+        conn.commit()
+        return
+
+    # handles both minio formats: namespace (key, value) and access (event_time, event_data)
+    try:
+        conn.execute(
+            sql.SQL(
+                """
+                CREATE OR REPLACE FUNCTION notify_import() RETURNS trigger AS $$
+                BEGIN
+                    IF to_jsonb(NEW) ->> 'key' LIKE 'cavepediav2-import/%'
+                        OR to_jsonb(NEW) #>> '{{event_data,Records,0,s3,bucket,name}}' = 'cavepediav2-import' THEN
+                        PERFORM pg_notify({channel}, '');
+                    END IF;
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql
+                """
+            ).format(channel=sql.Literal(IMPORT_CHANNEL))
+        )
+        conn.execute(
+            sql.SQL(
+                "CREATE OR REPLACE TRIGGER notify_import AFTER INSERT OR UPDATE ON {table} "
+                "FOR EACH ROW EXECUTE FUNCTION notify_import()"
+            ).format(table=sql.Identifier(MINIO_EVENTS_TABLE))
+        )
+    except psycopg.Error as e:
+        # e.g. the poller's role doesn't own minio's table; events only speed imports up, so carry on without them
+        conn.rollback()
+        logger.warning(f"Could not add a trigger to {MINIO_EVENTS_TABLE}, imports will be polled: {e}")
+        return
+    conn.commit()
+
+
+_listener = None
+
+
+def wait_for_import_event(timeout):
+    """Wait up to timeout seconds for minio to report a new object in the import bucket"""
+    global _listener
+    try:
+        if _listener is None or _listener.closed:
+            _listener = connect(autocommit=True)
+            _listener.execute(sql.SQL("LISTEN {}").format(sql.Identifier(IMPORT_CHANNEL)))
+
+        for _ in _listener.notifies(timeout=timeout, stop_after=1):
+            # uploads arrive in bursts; let the rest of the burst land before importing
+            for _ in _listener.notifies(timeout=2):
+                pass
+            logger.info("Import bucket event received.")
+            return True
+        return False
+    except psycopg.Error as e:
+        logger.warning(f"Listening for import events failed, polling instead: {e}")
+        if _listener is not None:
+            _listener.close()
+        time.sleep(timeout)
+        return False
 
 
 def import_files():
     """Scan import bucket for any new files; move them to the files bucket and add to db; delete from import bucket"""
+    with advisory_lock("import_files") as locked:
+        if not locked:
+            logger.info("Another poller is importing files, skipping.")
+            return
+        _import_files()
+
+
+files_imported = threading.Event()
+
+
+def wait_for_imported_files(timeout):
+    """Wait up to timeout seconds for the import stage to bring in new files"""
+    imported = files_imported.wait(timeout)
+    files_imported.clear()
+    return imported
+
+
+def _import_files():
     BUCKET_IMPORT = "cavepediav2-import"
     BUCKET_FILES = "cavepediav2-files"
-    # get new files; add to db, sync to main bucket; delete from import bucket
-    response = s3.list_objects_v2(Bucket=BUCKET_IMPORT)
-    if "Contents" in response:
-        for obj in response["Contents"]:
-            if obj["Key"].endswith("/"):
-                continue
-            s3.copy_object(
-                CopySource={"Bucket": BUCKET_IMPORT, "Key": obj["Key"]},
-                Bucket=BUCKET_FILES,
-                Key=obj["Key"],
-            )
-            conn.execute("INSERT INTO metadata (bucket, key) VALUES(%s, %s);", (BUCKET_FILES, obj["Key"]))
-            conn.commit()
-            s3.delete_object(
-                Bucket=BUCKET_IMPORT,
-                Key=obj["Key"],
-            )
+    conn = get_conn()
+    # get new files a listing page (up to 1000) at a time; sync to main bucket, add to db; delete from import bucket
+    imported = 0
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=BUCKET_IMPORT):
+        keys = [obj["Key"] for obj in page.get("Contents", []) if not obj["Key"].endswith("/")]
+        if not keys:
+            continue
+
+        copied = copy_objects(BUCKET_IMPORT, BUCKET_FILES, keys)
+        # a re-uploaded file is split again; split_file skips it if its contents haven't changed
+        conn.execute(
+            """
+            INSERT INTO metadata (bucket, key) SELECT %s, unnest(%s::text[])
+            ON CONFLICT (bucket, key) DO UPDATE SET split = false, split_attempts = 0, split_error = NULL;
+            """,
+            (BUCKET_FILES, copied),
+        )
+        conn.commit()
+        delete_objects(BUCKET_IMPORT, copied)
+
+        imported += len(copied)
+        if copied:
+            files_imported.set()
+        logger.info(f"Imported {len(copied)} of {len(keys)} files from s3://{BUCKET_IMPORT}")
+    logger.info(f"Imported {imported} files.")
+
+
+def copy_objects(source_bucket, dest_bucket, keys):
+    """Copy objects between buckets with a pool of S3 workers; returns the keys that were copied"""
+
+    def copy(key):
+        s3.copy_object(CopySource={"Bucket": source_bucket, "Key": key}, Bucket=dest_bucket, Key=key)
+
+    copied = []
+    with ThreadPoolExecutor(max_workers=S3_WORKERS) as pool:
+        futures = {pool.submit(copy, key): key for key in keys}
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                future.result()
+                copied.append(key)
+            except Exception as e:
+                logger.error(f"Failed to copy s3://{source_bucket}/{key} to s3://{dest_bucket}: {e}")
+    return copied
+
+
+def delete_objects(bucket, keys):
+    """Delete objects in batches of 1000, the most delete_objects accepts"""
+    for i in range(0, len(keys), 1000):
+        response = s3.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in keys[i : i + 1000]], "Quiet": True},
+        )
+        for error in response.get("Errors", []):
+            logger.error(f"Failed to delete s3://{bucket}/{error.get('Key')}: {error.get('Message')}")
 
 
 def split_files():
     """Split PDFs into single pages for easier processing"""
-    BUCKET_PAGES = "cavepediav2-pages"
-    rows = conn.execute("SELECT COUNT(*) FROM metadata WHERE split = false")
+    conn = get_conn()
+    rows = conn.execute(
+        "SELECT COUNT(*) FROM metadata WHERE split = false AND split_attempts < %s", (SPLIT_MAX_ATTEMPTS,)
+    )
     row = rows.fetchone()
     assert row is not None
+    conn.commit()
     logger.info(f"Found {row['count']} files to split.")
-    rows = conn.execute("SELECT * FROM metadata WHERE split = false")
 
-    for row in rows:
-        bucket = row["bucket"]
-        key = row["key"]
+    # claim one file at a time; the row stays locked until split_file commits
+    failed: list[int] = []
+    while True:
+        row = conn.execute(
+            """
+            SELECT * FROM metadata WHERE split = false AND split_attempts < %s AND NOT id = ANY(%s)
+            ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED
+            """,
+            (SPLIT_MAX_ATTEMPTS, failed),
+        ).fetchone()
+        if row is None:
+            conn.commit()
+            break
+        try:
+            split_file(row)
+        except Exception as e:
+            # record the failure and move on, so one bad file doesn't hold up the files after it
+            logger.exception(f"Failed to split bucket: {row['bucket']}, key: {row['key']}")
+            conn.rollback()
+            conn.execute(
+                "UPDATE metadata SET split_attempts = split_attempts + 1, split_error = %s WHERE id = %s",
+                (str(e), row["id"]),
+            )
+            conn.commit()
+            failed.append(row["id"])
+            if isinstance(e, BrokenProcessPool):
+                # a split worker died (e.g. OOM-killed on a huge file), which breaks the pool for good, and it can't
+                # be forked again now that other threads are running; exit so the container is restarted instead
+                logger.critical("A split worker process died, exiting so the poller is restarted.")
+                os._exit(1)
 
-        with conn.cursor() as cur:
-            logger.info(f"Splitting bucket: {bucket}, key: {key}")
-
-            ##### get pdf #####
-            s3.download_file(bucket, key, "/tmp/file.pdf")
-
-            ##### split #####
-            with open("/tmp/file.pdf", "rb") as f:
-                reader = PdfReader(f)
-
-                # Handle PDFs with permission restrictions (no password, but encrypted)
-                if reader.is_encrypted:
-                    reader.decrypt("")
-
-                for i in range(len(reader.pages)):
-                    writer = PdfWriter()
-                    writer.add_page(reader.pages[i])
-
-                    with io.BytesIO() as bs:
-                        writer.write(bs)
-                        bs.seek(0)
-                        s3.put_object(Bucket=BUCKET_PAGES, Key=f"{key}/page-{i + 1}.pdf", Body=bs.getvalue())
-                    page_key = f"{key}/page-{i + 1}.pdf"
-                    role = key.split("/")[0]
-                    cur.execute(
-                        "INSERT INTO embeddings (bucket, key, role) VALUES (%s, %s, %s);",
-                        (BUCKET_PAGES, page_key, role),
-                    )
-            cur.execute("UPDATE metadata SET SPLIT = true WHERE id = %s", (row["id"],))
-        conn.commit()
+
+def split_file(row):
+    """Split one PDF; pages are split across worker processes and uploaded by a pool of S3 workers"""
+    BUCKET_PAGES = "cavepediav2-pages"
+    bucket = row["bucket"]
+    key = row["key"]
+    role = key.split("/")[0]
+    conn = get_conn()
+    logger.info(f"Splitting bucket: {bucket}, key: {key}")
+
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as f:
+        ##### get pdf #####
+        s3.download_fileobj(bucket, key, f)
+        f.flush()
+        size = f.tell()
+
+        f.seek(0)
+        sha256 = hashlib.file_digest(f, "sha256").hexdigest()
+        if sha256 == row["sha256"]:
+            logger.info(f"Unchanged since it was last split, skipping bucket: {bucket}, key: {key}")
+            conn.execute("UPDATE metadata SET split = true WHERE id = %s", (row["id"],))
+            conn.commit()
+            return
+
+        reader = PdfReader(f.name)
+        # Handle PDFs with permission restrictions (no password, but encrypted)
+        if reader.is_encrypted:
+            reader.decrypt("")
+        page_count = len(reader.pages)
+
+        page_keys = [f"{key}/page-{i + 1}.pdf" for i in range(page_count)]
+        # pages split before pages were hashed have no stored hash, which would look like a change; hash what's in
+        # the bucket before it is overwritten, so unchanged pages keep their content
+        unhashed = conn.execute(
+            "SELECT key FROM embeddings WHERE bucket = %s AND key = ANY(%s) AND page_sha256 IS NULL",
+            (BUCKET_PAGES, page_keys),
+        ).fetchall()
+        with ThreadPoolExecutor(max_workers=S3_WORKERS) as downloader:
+            keys = [page["key"] for page in unhashed]
+            old_hashes = dict(zip(keys, downloader.map(lambda k: object_sha256(BUCKET_PAGES, k), keys), strict=True))
+
+        ##### split and upload #####
+        page_hashes = [""] * page_count
+        page_texts: list[str | None] = [None] * page_count
+        with ThreadPoolExecutor(max_workers=S3_WORKERS) as uploader:
+            uploads = []
+            for start, pages in split_pdf(f.name, page_count):
+                for i, (body, text) in enumerate(pages, start):
+                    page_hashes[i] = hashlib.sha256(body).hexdigest()
+                    page_texts[i] = text
+                    uploads.append(uploader.submit(s3.put_object, Bucket=BUCKET_PAGES, Key=page_keys[i], Body=body))
+            for upload in uploads:
+                upload.result()
+
+    with conn.cursor() as cur:
+        cur.executemany(
+            "UPDATE embeddings SET page_sha256 = %s WHERE bucket = %s AND key = %s AND page_sha256 IS NULL",
+            [
+                (page_hash, BUCKET_PAGES, page_key)
+                for page_key, page_hash in zip(page_keys, page_hashes)
+                if old_hashes.get(page_key) == page_hash
+            ],
+        )
+        # pages of a re-uploaded file that changed start over; unchanged pages keep their content and chunks.
+        # pages with a usable text layer get their content now, the rest are left for claude
+        cur.executemany(
+            """
+            INSERT INTO embeddings (bucket, key, role, page_sha256, content, status)
+            VALUES (%s, %s, %s, %s, %s, %s::page_status)
+            ON CONFLICT (bucket, key) DO UPDATE
+            SET page_sha256 = EXCLUDED.page_sha256, content = EXCLUDED.content, content_sha256 = NULL, embedding = NULL,
+                status = EXCLUDED.status, status_at = now(), attempts = 0
+            WHERE embeddings.page_sha256 IS DISTINCT FROM EXCLUDED.page_sha256;
+            """,
+            [
+                (BUCKET_PAGES, page_key, role, page_hash, text, "pending" if text is None else "ocred")
+                for page_key, page_hash, text in zip(page_keys, page_hashes, page_texts)
+            ],
+        )
+        cur.execute(
+            """
+            DELETE FROM chunks WHERE page_id IN
+            (SELECT id FROM embeddings WHERE bucket = %s AND key = ANY(%s) AND status IN ('pending', 'ocred'))
+            """,
+            (BUCKET_PAGES, page_keys),
+        )
+        # pages already OCR'd elsewhere (e.g. a newsletter that is also in a compilation) reuse that content
+        cur.execute(
+            """
+            UPDATE embeddings AS e SET content = d.content, status = 'ocred', status_at = now()
+            FROM (
+                SELECT DISTINCT ON (page_sha256) page_sha256, content FROM embeddings
+                WHERE page_sha256 = ANY(%s) AND status IN ('ocred', 'chunked', 'empty')
+            ) AS d
+            WHERE e.page_sha256 = d.page_sha256 AND e.bucket = %s AND e.key = ANY(%s) AND e.status = 'pending'
+            """,
+            (page_hashes, BUCKET_PAGES, page_keys),
+        )
+        logger.info(f"Reused OCR content for {cur.rowcount} of {page_count} pages from bucket: {bucket}, key: {key}")
+        cur.execute(
+            "UPDATE metadata SET split = true, sha256 = %s, size = %s, pages = %s, updated_at = now() WHERE id = %s",
+            (sha256, size, page_count, row["id"]),
+        )
+    conn.commit()
+    text_pages = sum(text is not None for text in page_texts)
+    pages_total.labels(stage="split").inc(page_count)
+    logger.info(f"Split {page_count} pages ({text_pages} from the text layer) from bucket: {bucket}, key: {key}")
+
+
+_split_pool: ProcessPoolExecutor | None = None
+
+
+def get_split_pool():
+    """Lazily start the page splitting process pool"""
+    global _split_pool
+    if _split_pool is None:
+        # fork, so workers don't re-import this module (which connects to s3 and the db at import time)
+        _split_pool = ProcessPoolExecutor(max_workers=SPLIT_PROCESSES, mp_context=multiprocessing.get_context("fork"))
+        # forked pools start every worker on first submit; do it now, before any other threads exist (see __main__)
+        _split_pool.submit(int).result()
+    return _split_pool
+
+
+def split_pdf(path, page_count):
+    """Yield (first page index, [(page pdf, text or None)]) for page ranges, in the order the workers finish them"""
+    step = max(1, math.ceil(page_count / (SPLIT_PROCESSES * 4)))
+    ranges = [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+    if SPLIT_PROCESSES <= 1:
+        for start, end in ranges:
+            yield start, split_page_range(path, start, end)
+        return
+
+    pool = get_split_pool()
+    futures = {pool.submit(split_page_range, path, start, end): start for start, end in ranges}
+    for future in as_completed(futures):
+        yield futures[future], future.result()
+
+
+def split_page_range(path, start, end):
+    """Split pages [start, end) of a PDF into single page PDFs, with their text layer if it's usable; runs in a
+    worker process"""
+    reader = PdfReader(path)
+    if reader.is_encrypted:
+        reader.decrypt("")
+
+    pages = []
+    for i in range(start, end):
+        writer = PdfWriter()
+        writer.add_page(reader.pages[i])
+        with io.BytesIO() as bs:
+            writer.write(bs)
+            pages.append((bs.getvalue(), extract_text_layer(reader.pages[i])))
+    return pages
+
+
+def extract_text_layer(page):
+    """Return a page's embedded text if it looks like real text, or None if the page needs OCR"""
+    try:
+        text = page.extract_text()
+    except Exception as e:
+        logger.warning(f"Failed to extract text layer: {e}")
+        return None
+    # postgres text can't hold NUL
+    text = text.replace("\x00", "").strip()
+    if len(text) < TEXT_LAYER_MIN_CHARS or text_layer_score(text) < TEXT_LAYER_MIN_SCORE:
+        return None
+    return text
+
+
+def text_layer_score(text):
+    """Score a text layer from 0 to 1 by how much of it is made of plausible words.
+
+    Scanned pages usually have no text layer, and bad embedded OCR or broken font encodings show up as
+    runs of symbols, single letters and words with no vowels."""
+    tokens = text.split()
+    if not tokens:
+        return 0.0
+    printable = sum(c.isprintable() or c.isspace() for c in text) / len(text)
+    words = 0
+    for token in tokens:
+        token = token.strip(".,;:!?()[]{}\"'-")
+        if (
+            token.isdigit()
+            or (len(token) > 1 and token.isalpha() and any(c in "aeiouyAEIOUY" for c in token))
+            or token in ("a", "A", "I", "&")
+        ):
+            words += 1
+    return printable * words / len(tokens)
 
 
 def ocr_create_message(id, bucket, key):
@@ -232,8 +937,10 @@ def ocr(bucket, key):
 def claude_send_batch(batch):
     """Send a batch to claude"""
     client = anthropic.Anthropic()
-    message_batch = client.messages.batches.create(requests=batch)
+    with ocr_submit_seconds.time():
+        message_batch = client.messages.batches.create(requests=batch)
 
+    conn = get_conn()
     conn.execute(
         "INSERT INTO batches (platform, batch_id, type) VALUES(%s, %s, %s);", ("claude", message_batch.id, "ocr")
     )
@@ -244,31 +951,67 @@ def claude_send_batch(batch):
 
 def check_batches():
     """Check batch status"""
-    rows = conn.execute("SELECT COUNT(*) FROM batches WHERE done = false")
-    row = rows.fetchone()
-    assert row is not None
-    logger.info(f"Found {row['count']} batch(es) to process.")
-    rows = conn.execute("SELECT * FROM batches WHERE done = false")
+    conn = get_conn()
+    rows = conn.execute("SELECT id, batch_id FROM batches WHERE done = false ORDER BY id").fetchall()
+    conn.commit()
+    logger.info(f"Found {len(rows)} batch(es) to process.")
 
+    # poll every batch at once; only the ones that have ended need applying
     client = anthropic.Anthropic()
-    for row in rows:
-        message_batch = client.messages.batches.retrieve(
-            row["batch_id"],
-        )
-        if message_batch.processing_status == "ended":
-            results = client.messages.batches.results(
-                row["batch_id"],
-            )
-            with conn.cursor() as cur:
-                for result in results:
-                    id = int(result.custom_id.split("-")[1])
-                    try:
-                        content = result.result.message.content[0].text  # type: ignore[union-attr]
-                        cur.execute("UPDATE embeddings SET content = %s WHERE id = %s;", (content, id))
-                    except Exception:
-                        cur.execute("UPDATE embeddings SET content = %s WHERE id = %s;", ("ERROR", id))
-                cur.execute("UPDATE batches SET done = true WHERE batch_id = %s;", (row["batch_id"],))
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        statuses = list(pool.map(lambda row: client.messages.batches.retrieve(row["batch_id"]).processing_status, rows))
+
+    for row, status in zip(rows, statuses, strict=True):
+        if status != "ended":
+            continue
+        # claim the batch; skip it if another poller is already applying it
+        row = conn.execute(
+            "SELECT * FROM batches WHERE id = %s AND done = false FOR UPDATE SKIP LOCKED", (row["id"],)
+        ).fetchone()
+        if row is None:
             conn.commit()
+            continue
+        with ocr_apply_seconds.time():
+            apply_batch_results(client, row["batch_id"])
+        ocr_batch_age_seconds.observe((datetime.now(UTC) - row["created_at"]).total_seconds())
+        conn.execute("UPDATE batches SET done = true WHERE id = %s;", (row["id"],))
+        conn.commit()
+
+
+def apply_batch_results(client, batch_id):
+    """Stream a finished batch's results into a staging table, then merge them with a single UPDATE"""
+    conn = get_conn()
+    with conn.cursor() as cur:
+        cur.execute("CREATE TEMP TABLE ocr_results (id INTEGER, content TEXT, errored BOOLEAN) ON COMMIT DROP")
+        with cur.copy("COPY ocr_results (id, content, errored) FROM STDIN") as copy:
+            for result in client.messages.batches.results(batch_id):
+                id = int(result.custom_id.split("-")[1])
+                content = None
+                if result.result.type == "succeeded" and result.result.message.content:
+                    content = getattr(result.result.message.content[0], "text", None)
+                # canceled and expired requests aren't the page's fault, so they don't use up an attempt
+                errored = content is None and result.result.type not in ("canceled", "expired")
+                copy.write_row((id, content, errored))
+
+        # failed pages go back in the queue until they run out of attempts
+        cur.execute(
+            """
+            UPDATE embeddings AS e SET
+                content = r.content,
+                status = CASE
+                    WHEN r.content IS NOT NULL THEN 'ocred'
+                    WHEN r.errored AND e.attempts + 1 >= %s THEN 'error'
+                    ELSE 'pending'
+                END::page_status,
+                status_at = now(),
+                attempts = e.attempts + CASE WHEN r.errored THEN 1 ELSE 0 END
+            FROM ocr_results AS r
+            WHERE e.id = r.id AND e.status = 'ocr'
+            """,
+            (OCR_MAX_ATTEMPTS,),
+        )
+        pages_total.labels(stage="ocr").inc(cur.rowcount)
+        logger.info(f"Applied {cur.rowcount} OCR results from batch_id {batch_id}")
 
 
 def ocr_main():
@@ -278,74 +1021,281 @@ def ocr_main():
     # tier 2: enough
     # single pdf page: up to 2k tokens
 
-    # get docs where content is null
-    rows = conn.execute("SELECT COUNT(*) FROM embeddings WHERE content IS NULL LIMIT 1000")
-    row = rows.fetchone()
+    conn = get_conn()
+    # pages whose batch never came back (e.g. it was lost before it was recorded) go back in the queue
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE embeddings SET
+                status = CASE WHEN attempts + 1 >= %s THEN 'error' ELSE 'pending' END::page_status,
+                status_at = now(),
+                attempts = attempts + 1
+            WHERE status = 'ocr' AND status_at < now() - make_interval(secs => %s)
+            """,
+            (OCR_MAX_ATTEMPTS, OCR_TIMEOUT_HOURS * 3600),
+        )
+        if cur.rowcount:
+            logger.warning(f"Re-queued {cur.rowcount} pages that were sent to claude over {OCR_TIMEOUT_HOURS}h ago.")
+    conn.commit()
+
+    # get pages waiting for OCR
+    row = conn.execute(
+        """
+        SELECT (SELECT COUNT(*) FROM embeddings WHERE status = 'pending') AS backlog,
+            (SELECT COUNT(*) FROM batches WHERE done = false AND type = 'ocr') AS in_flight
+        """
+    ).fetchone()
     assert row is not None
-    logger.info(f"Batching {row['count']} documents to generate OCR content.")
-    rows = conn.execute("SELECT * FROM embeddings WHERE content IS NULL LIMIT 1000")
+    conn.commit()
+    sizes = plan_ocr_batches(row["backlog"], row["in_flight"])
+    logger.info(f"Batching {sum(sizes)} of {row['backlog']} documents to generate OCR content in batches of {sizes}.")
+
+    for size in sizes:
+        rows = conn.execute(
+            """
+            SELECT id, bucket, key FROM embeddings WHERE status = 'pending'
+            ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED
+            """,
+            (size,),
+        ).fetchall()
+        if not rows:
+            conn.commit()
+            break
+
+        # batch docs; mark them as being OCR'd
+        ids = [row["id"] for row in rows]
+        batch = [ocr_create_message(row["id"], row["bucket"], row["key"]) for row in rows]
+        conn.execute("UPDATE embeddings SET status = 'ocr', status_at = now() WHERE id = ANY(%s);", (ids,))
+        conn.commit()
+        try:
+            claude_send_batch(batch)
+        except Exception:
+            # put the pages back in the queue rather than waiting for them to time out
+            conn.execute(
+                "UPDATE embeddings SET status = 'pending', status_at = now() WHERE id = ANY(%s) AND status = 'ocr';",
+                (ids,),
+            )
+            conn.commit()
+            raise
+
 
-    # batch docs; set content = WIP
-    batch = []
-    for row in rows:
-        id = row["id"]
-        bucket = row["bucket"]
-        key = row["key"]
+def plan_ocr_batches(backlog, in_flight):
+    """Size this cycle's OCR batches from the backlog, free in-flight slots, token budget and file server latency"""
+    slots = min(OCR_MAX_BATCHES_PER_CYCLE, OCR_MAX_BATCHES_IN_FLIGHT - in_flight)
+    if backlog == 0 or slots <= 0:
+        return []
 
-        logger.info(f"Batching for OCR: {bucket}, key: {key}")
+    batch_size = OCR_BATCH_SIZE_MAX
+    latency = probe_file_server()
+    if latency > OCR_S3_SLOW_SECONDS:
+        logger.warning(f"File server took {latency:.2f}s to respond, sending a single smaller batch.")
+        batch_size = max(OCR_BATCH_SIZE_MIN, batch_size // 2)
+        slots = 1
+
+    pages = min(backlog, OCR_TOKEN_BUDGET // OCR_TOKENS_PER_PAGE, slots * batch_size)
+    if pages <= 0:
+        return []
+    # spread the pages evenly over as few batches as will hold them
+    count = math.ceil(pages / batch_size)
+    return [pages // count + (1 if i < pages % count else 0) for i in range(count)]
+
+
+def probe_file_server():
+    """Time a request to the file server claude downloads pages from"""
+    start = time.monotonic()
+    try:
+        s3.head_bucket(Bucket="cavepediav2-pages")
+    except Exception as e:
+        logger.warning(f"File server probe failed: {e}")
+        return math.inf
+    return time.monotonic() - start
+
+
+def chunk_main():
+    """Split OCR'd pages into overlapping chunks, which are embedded and searched instead of whole pages"""
+    conn = get_conn()
+    count_query = "SELECT COUNT(*) FROM embeddings WHERE status = 'ocred'"
+    row = conn.execute(count_query).fetchone()
+    assert row is not None
+    conn.commit()
+    logger.info(f"Found {row['count']} pages to chunk.")
+    claim_query = """
+        SELECT id, role, content FROM embeddings
+        WHERE status = 'ocred'
+        ORDER BY id
+        LIMIT 1000
+        FOR UPDATE SKIP LOCKED
+    """
 
-        batch.append(ocr_create_message(id, bucket, key))
-        conn.execute("UPDATE embeddings SET content = %s WHERE id = %s;", ("WIP", id))
+    while True:
+        claimed = conn.execute(claim_query).fetchall()
+        if not claimed:
+            conn.commit()
+            break
+        pages = [page for page in claimed if len(page["content"]) > MIN_CONTENT_LENGTH]
+        hashes = {page["id"]: hashlib.sha256(page["content"].encode()).hexdigest() for page in pages}
+        ids = [page["id"] for page in pages]
+
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE embeddings AS e SET content_sha256 = v.hash FROM unnest(%s::int[], %s::text[]) AS v(id, hash) "
+                "WHERE e.id = v.id",
+                (list(hashes), list(hashes.values())),
+            )
+            # pages with the same text as an already chunked page copy its chunks and vectors
+            donors = cur.execute(
+                """
+                SELECT DISTINCT ON (content_sha256) content_sha256, id FROM embeddings
+                WHERE content_sha256 = ANY(%s) AND status = 'chunked' AND id != ALL(%s)
+                """,
+                (list(set(hashes.values())), ids),
+            ).fetchall()
+            donor_ids = {donor["content_sha256"]: donor["id"] for donor in donors}
+            reused = [page for page in pages if hashes[page["id"]] in donor_ids]
+            cur.executemany(
+                """
+                INSERT INTO chunks (page_id, chunk_index, role, content, embedding)
+                SELECT %s, chunk_index, %s, content, embedding FROM chunks WHERE page_id = %s
+                ON CONFLICT DO NOTHING;
+                """,
+                [(page["id"], page["role"], donor_ids[hashes[page["id"]]]) for page in reused],
+            )
+            cur.executemany(
+                """
+                INSERT INTO chunks (page_id, chunk_index, role, content) VALUES (%s, %s, %s, %s)
+                ON CONFLICT DO NOTHING;
+                """,
+                [
+                    (page["id"], i, page["role"], chunk)
+                    for page in pages
+                    if hashes[page["id"]] not in donor_ids
+                    for i, chunk in enumerate(chunk_text(page["content"]))
+                ],
+            )
+            # pages too short to search are done too, but kept apart so they can be told from chunked ones
+            cur.execute(
+                """
+                UPDATE embeddings SET status = CASE WHEN id = ANY(%s) THEN 'chunked' ELSE 'empty' END::page_status,
+                    status_at = now()
+                WHERE id = ANY(%s)
+                """,
+                (ids, [page["id"] for page in claimed]),
+            )
+            clear_page_vectors(cur, [page["id"] for page in claimed])
         conn.commit()
-    if len(batch) > 0:
-        claude_send_batch(batch)
+        pages_total.labels(stage="chunk").inc(len(claimed))
+        logger.info(f"Chunked {len(claimed)} pages, reusing the chunks of an identical page for {len(reused)}.")
+
+
+def chunk_text(text):
+    """Split text into windows of CHUNK_SIZE words, each overlapping the previous by CHUNK_OVERLAP words"""
+    words = [match.span() for match in re.finditer(r"\S+", text)]
+    step = max(1, CHUNK_SIZE - CHUNK_OVERLAP)
+    chunks = []
+    for start in range(0, len(words), step):
+        window = words[start : start + CHUNK_SIZE]
+        chunks.append(text[window[0][0] : window[-1][1]])
+        if start + CHUNK_SIZE >= len(words):
+            break
+    return chunks
 
 
 def embeddings_main():
-    """Generate embeddings"""
-    count_query = """
-        SELECT COUNT(*) FROM embeddings
-        WHERE content IS NOT NULL AND content != 'ERROR' AND content != 'WIP' AND embedding IS NULL
-    """
-    rows = conn.execute(count_query)
+    """Generate chunk embeddings in batches, with up to EMBED_CONCURRENCY batches in flight"""
+    conn = get_conn()
+    rows = conn.execute("SELECT COUNT(*) FROM chunks WHERE embedding IS NULL")
     row = rows.fetchone()
     assert row is not None
-    logger.info(f"Batching {row['count']} documents to generate embeddings.")
-    select_query = """
-        SELECT id, key, bucket, content FROM embeddings
-        WHERE content IS NOT NULL AND content != 'ERROR' AND content != 'WIP' AND embedding IS NULL
+    conn.commit()
+    logger.info(f"Batching {row['count']} chunks to generate embeddings.")
+    claim_query = """
+        SELECT id, page_id, content FROM chunks
+        WHERE embedding IS NULL
+        ORDER BY id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
     """
-    rows = conn.execute(select_query)
 
-    for row in rows:
-        logger.info(f"Generating embeddings for id: {row['id']}, bucket: {row['bucket']}, key: {row['key']}")
-        embedding = embed(row["content"], "search_document")
-        conn.execute("UPDATE embeddings SET embedding = %s::vector WHERE id = %s;", (embedding, row["id"]))
+    # claim enough rows to keep every in-flight slot busy; the rows stay locked until commit
+    while True:
+        pending = conn.execute(claim_query, (EMBED_BATCH_SIZE * EMBED_CONCURRENCY,)).fetchall()
+        if not pending:
+            conn.commit()
+            break
+        failed = embed_rows(pending)
+        with conn.cursor() as cur:
+            clear_page_vectors(cur, list({row["page_id"] for row in pending}))
         conn.commit()
+        if failed:
+            # leave the failed rows for the next cycle rather than retrying them straight away
+            break
 
 
-### embeddings
-def embed(text, input_type):
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            resp = co.embed(
-                texts=[text],
-                model="embed-v4.0",
-                input_type=input_type,
-                embedding_types=["float"],
-                output_dimension=1536,
-            )
-            assert resp.embeddings.float_ is not None
-            return resp.embeddings.float_[0]
-        except ApiError as e:
-            if e.status_code == 502 and attempt < max_retries - 1:
-                time.sleep(30**attempt)  # exponential backoff
+def clear_page_vectors(cur, page_ids):
+    """Drop the whole-page vectors of pages whose chunks are all embedded, so search uses the chunks instead"""
+    cur.execute(
+        """
+        UPDATE embeddings AS e SET embedding = NULL
+        WHERE e.id = ANY(%s) AND e.embedding IS NOT NULL
+            AND NOT EXISTS (SELECT 1 FROM chunks c WHERE c.page_id = e.id AND c.embedding IS NULL)
+        """,
+        (page_ids,),
+    )
+
+
+def embed_rows(rows):
+    """Embed chunks in concurrent batches and store the vectors; returns whether any batch failed"""
+    batches = [rows[i : i + EMBED_BATCH_SIZE] for i in range(0, len(rows), EMBED_BATCH_SIZE)]
+    failed = False
+
+    with ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY) as pool:
+        futures = {
+            pool.submit(embed_batch, [row["content"] for row in batch], "search_document"): batch for batch in batches
+        }
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                embeddings = future.result()
+            except Exception as e:
+                logger.error(f"Failed to embed batch of {len(batch)} starting at chunk id: {batch[0]['id']}: {e}")
+                failed = True
                 continue
-            raise Exception("cohere max retries exceeded")
+            store_embeddings([row["id"] for row in batch], embeddings)
+            chunks_embedded_total.inc(len(batch))
+            logger.info(f"Stored embeddings for {len(batch)} chunks starting at id: {batch[0]['id']}")
+    return failed
+
+
+def store_embeddings(ids, embeddings):
+    """Write a batch of embeddings back with a single multi-row UPDATE"""
+    values = ", ".join(["(%s::int, %s::vector)"] * len(ids))
+    params = [param for pair in zip(ids, embeddings, strict=True) for param in pair]
+    get_conn().execute(
+        f"""
+        UPDATE chunks AS c SET embedding = v.embedding
+        FROM (VALUES {values}) AS v(id, embedding)
+        WHERE c.id = v.id
+        """,
+        params,
+    )
+
+
+### embeddings
+def embed_batch(texts, input_type):
+    """Embed up to 96 texts in a single cohere request"""
+    resp = co.embed(
+        texts=texts,
+        model="embed-v4.0",
+        input_type=input_type,
+        embedding_types=["float"],
+        output_dimension=1536,
+    )
+    assert resp.embeddings.float_ is not None
+    return resp.embeddings.float_
 
 
 def fix_pages():
+    conn = get_conn()
     i = 766
     while i > 0:
         new_key = f"public/va/caves-of-virginia.pdf/page-{i}.pdf"
@@ -357,31 +1307,222 @@ def fix_pages():
 
 def upload_file_list():
     """Upload a list of all processed files to S3"""
+    with advisory_lock("upload_file_list") as locked:
+        if not locked:
+            logger.info("Another poller is uploading the file list, skipping.")
+            return
+        _upload_file_list()
+
+
+def _upload_file_list():
     BUCKET_PUBLIC = "cavepediav2-public"
 
-    rows = conn.execute("SELECT key FROM metadata WHERE split = true ORDER BY key")
+    conn = get_conn()
+    # the manifest only changes when a file is split, so skip the rest unless one has been since the last upload
+    row = conn.execute(
+        "SELECT COUNT(*) AS count, MAX(updated_at) AS updated_at FROM metadata WHERE split = true"
+    ).fetchone()
+    assert row is not None
+    version = f"{row['count']}:{row['updated_at']}"
+    state = conn.execute("SELECT version FROM manifests WHERE key = 'files.json.gz'").fetchone()
+    conn.commit()
+    if state is not None and state["version"] == version:
+        logger.info("No files changed since the file list was last uploaded, skipping.")
+        return
+
+    backfill_manifest_columns()
+    rows = conn.execute("SELECT key, size, pages, sha256 FROM metadata WHERE split = true ORDER BY key").fetchall()
+    conn.commit()
+
     files = [row["key"] for row in rows]
+    publish(BUCKET_PUBLIC, "files.txt", "\n".join(files).encode("utf-8"), version, ContentType="text/plain")
+    # mtime=0 so the same manifest always compresses to the same bytes, and so the same etag
+    manifest = json.dumps({"files": [dict(row) for row in rows]}, separators=(",", ":"))
+    publish(
+        BUCKET_PUBLIC,
+        "files.json.gz",
+        gzip.compress(manifest.encode("utf-8"), mtime=0),
+        version,
+        ContentType="application/json",
+        ContentEncoding="gzip",
+    )
+    logger.info(f"Uploaded file list with {len(files)} files to s3://{BUCKET_PUBLIC}/files.json.gz")
+
 
-    content = "\n".join(files)
-    s3.put_object(
-        Bucket=BUCKET_PUBLIC,
-        Key="files.txt",
-        Body=content.encode("utf-8"),
-        ContentType="text/plain",
+def publish(bucket, key, body, version, **kwargs):
+    """Upload body to bucket/key unless it's already there, conditional on the object not having changed since
+    the last upload"""
+    conn = get_conn()
+    state = conn.execute("SELECT version, etag FROM manifests WHERE key = %s", (key,)).fetchone()
+    conn.commit()
+
+    # single part uploads have the body's md5 as their etag
+    etag = f'"{hashlib.md5(body).hexdigest()}"'
+    if state is None or state["etag"] != etag:
+        condition = {"IfNoneMatch": "*"} if state is None or state["etag"] is None else {"IfMatch": state["etag"]}
+        try:
+            response = s3.put_object(Bucket=bucket, Key=key, Body=body, **condition, **kwargs)
+            etag = response["ETag"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("PreconditionFailed", "ConditionalRequestConflict"):
+                raise
+            # something else wrote the object; remember its etag so the next run overwrites it
+            logger.warning(f"s3://{bucket}/{key} changed since it was last uploaded, retrying next run.")
+            version, etag = None, s3.head_object(Bucket=bucket, Key=key)["ETag"]
+    else:
+        logger.info(f"s3://{bucket}/{key} is unchanged, skipping upload.")
+
+    conn.execute(
+        """
+        INSERT INTO manifests (key, version, etag) VALUES (%s, %s, %s)
+        ON CONFLICT (key) DO UPDATE SET version = EXCLUDED.version, etag = EXCLUDED.etag
+        """,
+        (key, version, etag),
     )
-    logger.info(f"Uploaded file list with {len(files)} files to s3://{BUCKET_PUBLIC}/files.txt")
+    conn.commit()
+
+
+def backfill_manifest_columns():
+    """Fill in page counts and sizes for files split before they were recorded"""
+    conn = get_conn()
+    row = conn.execute(
+        "SELECT EXISTS (SELECT 1 FROM metadata WHERE split = true AND pages IS NULL) AS missing"
+    ).fetchone()
+    assert row is not None
+    if row["missing"]:
+        logger.info("Counting the pages of files split before page counts were recorded.")
+        conn.execute(
+            """
+            UPDATE metadata AS m SET pages = COALESCE(p.pages, 0)
+            FROM metadata AS t LEFT JOIN (
+                SELECT regexp_replace(key, '/page-[0-9]+[.]pdf$', '') AS key, COUNT(*) AS pages FROM embeddings
+                GROUP BY 1
+            ) AS p ON p.key = t.key
+            WHERE m.id = t.id AND m.split = true AND m.pages IS NULL
+            """
+        )
+    rows = conn.execute("SELECT id, bucket, key FROM metadata WHERE split = true AND size IS NULL").fetchall()
+    conn.commit()
+    if not rows:
+        return
+
+    logger.info(f"Looking up the size of {len(rows)} files.")
+    with ThreadPoolExecutor(max_workers=S3_WORKERS) as pool:
+        sizes = list(pool.map(lambda row: object_size(row["bucket"], row["key"]), rows))
+    conn.execute(
+        "UPDATE metadata AS m SET size = v.size FROM unnest(%s::int[], %s::bigint[]) AS v(id, size) WHERE m.id = v.id",
+        ([row["id"] for row in rows], sizes),
+    )
+    conn.commit()
+
+
+def object_sha256(bucket, key):
+    """SHA-256 of an S3 object's contents, or None if it can't be found"""
+    try:
+        return hashlib.sha256(s3.get_object(Bucket=bucket, Key=key)["Body"].read()).hexdigest()
+    except ClientError as e:
+        logger.warning(f"Failed to hash s3://{bucket}/{key}: {e}")
+        return None
+
+
+def object_size(bucket, key):
+    """Size of an S3 object, or None if it can't be found"""
+    try:
+        return s3.head_object(Bucket=bucket, Key=key)["ContentLength"]
+    except ClientError as e:
+        logger.warning(f"Failed to get the size of s3://{bucket}/{key}: {e}")
+        return None
+
+
+def update_queue_metrics():
+    """Refresh the backlog gauges"""
+    conn = get_conn()
+    rows = conn.execute("SELECT status, COUNT(*) FROM embeddings GROUP BY status").fetchall()
+    counts = {row["status"]: row["count"] for row in rows}
+    row = conn.execute(
+        """
+        SELECT (SELECT COUNT(*) FROM chunks WHERE embedding IS NULL) AS chunks_unembedded,
+            (SELECT COUNT(*) FROM metadata WHERE split = false AND split_attempts < %(max)s) AS files_unsplit,
+            (SELECT COUNT(*) FROM metadata WHERE split = false AND split_attempts >= %(max)s) AS files_failed,
+            (SELECT COUNT(*) FROM batches WHERE done = false) AS batches_in_flight,
+            (SELECT EXTRACT(EPOCH FROM now() - MIN(created_at)) FROM batches WHERE done = false) AS oldest_batch
+        """,
+        {"max": SPLIT_MAX_ATTEMPTS},
+    ).fetchone()
+    assert row is not None
+    conn.commit()
+
+    for status in ("pending", "ocr", "ocred", "chunked", "empty", "error"):
+        pages_by_status.labels(status=status).set(counts.get(status, 0))
+    chunks_unembedded.set(row["chunks_unembedded"])
+    files_unsplit.set(row["files_unsplit"])
+    files_failed.set(row["files_failed"])
+    ocr_batches_in_flight.set(row["batches_in_flight"])
+    ocr_oldest_batch_seconds.set(row["oldest_batch"] or 0)
+
+
+# stage name: (stage, default interval, wait between runs)
+STAGES = {
+    "import": (import_files, 300, wait_for_import_event),
+    "split": (split_files, 60, wait_for_imported_files),
+    "check_batches": (check_batches, 60, time.sleep),
+    "ocr": (ocr_main, 300, time.sleep),
+    "chunk": (chunk_main, 60, time.sleep),
+    "embed": (embeddings_main, 60, time.sleep),
+    "manifest": (upload_file_list, 300, time.sleep),
+    "metrics": (update_queue_metrics, 60, time.sleep),
+}
+
+
+def run_serial():
+    """Run every stage in turn, then sleep until the next import event or POLL_INTERVAL"""
+    while True:
+        for name, (stage, _, _) in STAGES.items():
+            with stage_seconds.labels(stage=name).time():
+                stage()
+
+        logger.info(f"waiting up to {POLL_INTERVAL} seconds for new files")
+        wait_for_import_event(POLL_INTERVAL)
+
+
+def run_worker(name, stage, interval, wait):
+    """Run a single stage forever; wait(interval) returns early when there is new work"""
+    while True:
+        start = time.monotonic()
+        try:
+            with stage_seconds.labels(stage=name).time():
+                stage()
+        except Exception:
+            logger.exception(f"Stage {name} failed")
+            conn = get_conn()
+            # roll back whatever the stage left open, so its row locks aren't held until the next run
+            if conn.info.transaction_status != TransactionStatus.IDLE:
+                conn.rollback()
+        logger.info(f"Stage {name} finished in {time.monotonic() - start:.1f}s, waiting up to {interval} seconds")
+        wait(interval)
+
+
+def run_workers():
+    """Run each stage in its own thread; rows are claimed with SKIP LOCKED, so replicas can run side by side"""
+    threads = []
+    for name, (stage, default_interval, wait) in STAGES.items():
+        interval = int(os.environ.get(f"{name.upper()}_INTERVAL", str(default_interval)))
+        thread = threading.Thread(target=run_worker, args=(name, stage, interval, wait), name=name, daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
 
 
 if __name__ == "__main__":
     create_tables()
+    # the split pool forks its workers, so start it before the metrics server and stage threads
+    if SPLIT_PROCESSES > 1:
+        get_split_pool()
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
 
-    while True:
-        import_files()
-        split_files()
-        check_batches()
-        ocr_main()
-        embeddings_main()
-        upload_file_list()
-
-        logger.info("sleeping 5 minutes")
-        time.sleep(5 * 60)
+    if POLLER_MODE == "workers":
+        run_workers()
+    else:
+        run_serial()
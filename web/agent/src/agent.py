@@ -3,7 +3,14 @@ PydanticAI agent with MCP tools from Cavepedia server.
 """
 
 import os
+import json
+import time
+import asyncio
 import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import anyio
 import httpx
 import logfire
 
@@ -26,11 +33,19 @@ logfire.configure(
 logfire.instrument_pydantic_ai()
 logfire.instrument_httpx()
 
-from pydantic_ai import Agent, ModelMessage, RunContext
+from mcp.shared.exceptions import McpError
+from pydantic_ai import Agent, ModelMessage, ModelRetry, RunContext
 from pydantic_ai.settings import ModelSettings
-from pydantic_ai.mcp import CallToolFunc
+from pydantic_ai.mcp import CallToolFunc, MCPServerStreamableHTTP
+
+from src.answer_cache import answer_cache
 
 CAVE_MCP_URL = os.getenv("CAVE_MCP_URL", "https://mcp.caving.dev/mcp")
+# seconds between background MCP health checks
+MCP_HEALTH_INTERVAL = float(os.getenv("MCP_HEALTH_INTERVAL", "15"))
+# MCP sessions kept open (one per distinct roles/sources-only combination), and how long each is reused for
+MCP_SESSION_POOL_SIZE = int(os.getenv("MCP_SESSION_POOL_SIZE", "32"))
+MCP_SESSION_TTL = float(os.getenv("MCP_SESSION_TTL", "3600"))
 
 logger.info(f"Initializing Cavepedia agent with CAVE_MCP_URL={CAVE_MCP_URL}")
 
@@ -54,22 +69,208 @@ def limit_history(ctx: RunContext[None], messages: list[ModelMessage]) -> list[M
     return messages
 
 
-def check_mcp_available(url: str, timeout: float = 5.0) -> bool:
-    """Check if MCP server is reachable via health endpoint."""
+async def check_mcp_health(client: httpx.AsyncClient, url: str, timeout: float = 5.0) -> dict | None:
+    """Check if MCP server is reachable via health endpoint, returning its health status if it is."""
     try:
         # Use the health endpoint instead of the MCP endpoint
         health_url = url.rsplit("/", 1)[0] + "/health"
-        logger.info(f"Checking MCP health at: {health_url}")
-        response = httpx.get(health_url, timeout=timeout, follow_redirects=True)
+        response = await client.get(health_url, timeout=timeout, follow_redirects=True)
         if response.status_code == 200:
-            return True
+            return response.json()
         logger.warning(f"MCP health check returned {response.status_code}")
-        return False
+        return None
     except Exception as e:
         logger.warning(f"MCP server not reachable: {e}")
-        return False
+        return None
+
+
+class MCPHealthMonitor:
+    """Checks the MCP server's health in the background, so requests read a cached state instead of probing it."""
+
+    def __init__(self, url: str, interval: float):
+        self.url = url
+        self.interval = interval
+        self.available = False
+
+    async def check(self, client: httpx.AsyncClient):
+        status = await check_mcp_health(client, self.url)
+        available = status is not None
+        if status is not None:
+            answer_cache.set_corpus_version(status.get("corpus_version"))
+        if available != self.available:
+            logger.info(f"MCP server is now {'available' if available else 'unavailable'}")
+            if not available:
+                # sessions don't survive an MCP server restart; don't wait for requests still using them
+                mcp_sessions.drop_all()
+        self.available = available
+
+    async def run(self):
+        """Check health every interval, forever."""
+        async with httpx.AsyncClient() as client:
+            while True:
+                await self.check(client)
+                await asyncio.sleep(self.interval)
+
+
+class PooledMCPServer(MCPServerStreamableHTTP):
+    """An MCP server that counts the requests using it, so the pool can wait for them before closing it."""
+
+    def __post_init__(self):
+        super().__post_init__()
+        self.users = 0
+        self._released = asyncio.Condition()
+        # set when the session's transport fails, so calls waiting on it give up
+        self.failed = asyncio.Event()
+
+    async def __aenter__(self):
+        self.users += 1
+        try:
+            return await super().__aenter__()
+        except BaseException:
+            await self._release()
+            raise
+
+    async def __aexit__(self, *args):
+        try:
+            return await super().__aexit__(*args)
+        finally:
+            await self._release()
+
+    async def _release(self):
+        self.users -= 1
+        async with self._released:
+            self._released.notify_all()
+
+    async def direct_call_tool(self, name: str, args: dict, metadata: dict | None = None):
+        """Call a tool, retrying once on a fresh session if this one has died, e.g. because the MCP server restarted
+        between health checks and no longer knows the session."""
+        call = asyncio.ensure_future(super().direct_call_tool(name, args, metadata))
+        failed = asyncio.ensure_future(self.failed.wait())
+        try:
+            await asyncio.wait([call, failed], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            failed.cancel()
+            if not call.done():
+                # a failed transport never answers the call, so stop waiting for it
+                call.cancel()
+        try:
+            return await call
+        except asyncio.CancelledError:
+            reason: object = "session closed"
+        except (McpError, ModelRetry, httpx.TransportError) as e:
+            # pydantic-ai turns protocol errors like "Session terminated" into ModelRetry; errors from the tool itself
+            # are ModelRetry too, but without an McpError behind them
+            if isinstance(e, ModelRetry) and not isinstance(e.__context__, McpError):
+                raise
+            reason = e
+        logger.warning(f"MCP session failed, retrying on a new one: {reason}")
+        fresh = await mcp_sessions.replace(self)
+        return await super(PooledMCPServer, fresh).direct_call_tool(name, args, metadata)
+
+    async def wait_for_requests(self):
+        """Wait until the task holding the session is its only user."""
+        async with self._released:
+            await self._released.wait_for(lambda: self.users <= 1)
+
+
+class MCPSessionPool:
+    """Long-lived MCP client sessions keyed by (roles, sources_only), so requests skip the initialize and
+    list_tools handshake."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._sessions: OrderedDict = OrderedDict()
+        # sessions being opened, so concurrent requests for a key share one handshake without blocking other keys
+        self._opening: dict[tuple, asyncio.Task] = {}
+
+    async def get(self, user_roles: list[str], sources_only: bool) -> PooledMCPServer:
+        key = (tuple(sorted(user_roles)), sources_only)
+        session = self._sessions.get(key)
+        if session is not None and session["expires"] > time.monotonic() and not session["task"].done():
+            self._sessions.move_to_end(key)
+            return session["server"]
+        if session is not None:
+            self._sessions.pop(key)
+            session["stop"].set()
+
+        opening = self._opening.get(key)
+        if opening is None:
+            opening = asyncio.create_task(self._open(key, user_roles, sources_only))
+            self._opening[key] = opening
+            opening.add_done_callback(lambda _: self._opening.pop(key, None))
+        # shield so one request giving up doesn't cancel the handshake for the others
+        return await asyncio.shield(opening)
+
+    async def replace(self, server: PooledMCPServer) -> PooledMCPServer:
+        """Drop a session that has failed and return a new one for the same roles and sources-only mode."""
+        session = self._sessions.get(server.key)
+        if session is not None and session["server"] is server:
+            self._sessions.pop(server.key)
+            session["stop"].set()
+        roles, sources_only = server.key
+        return await self.get(list(roles), sources_only)
+
+    async def _open(self, key: tuple, user_roles: list[str], sources_only: bool) -> PooledMCPServer:
+        server = PooledMCPServer(
+            url=CAVE_MCP_URL,
+            headers={
+                "x-user-roles": json.dumps(user_roles),
+                "x-sources-only": "true" if sources_only else "false",
+            },
+            timeout=30.0,
+            process_tool_call=limit_searches,
+        )
+        server.key = key
+        ready = asyncio.get_running_loop().create_future()
+        stop = asyncio.Event()
+        # the session is entered and exited by its own task, since anyio requires both to happen in one task
+        task = asyncio.create_task(self._hold(server, ready, stop))
+        await ready
+        logger.info(f"Opened MCP session with roles: {user_roles}, sources_only: {sources_only}")
+
+        self._sessions[key] = {"server": server, "stop": stop, "task": task, "expires": time.monotonic() + self.ttl}
+        while len(self._sessions) > self.maxsize:
+            _, evicted = self._sessions.popitem(last=False)
+            evicted["stop"].set()
+        return server
+
+    async def _hold(self, server: PooledMCPServer, ready: asyncio.Future, stop: asyncio.Event):
+        """Keep a session open until stop is set and the requests still using it have finished."""
+        try:
+            async with server:
+                ready.set_result(None)
+                try:
+                    await stop.wait()
+                except asyncio.CancelledError:
+                    # the transport failed and cancelled this task
+                    server.failed.set()
+                    raise
+                finally:
+                    # shielded, so requests leave the session before this task closes it, even after a failure
+                    with anyio.CancelScope(shield=True):
+                        await server.wait_for_requests()
+        except Exception as e:
+            if not ready.done():
+                ready.set_exception(e)
+            else:
+                logger.warning(f"MCP session failed: {e}")
+
+    def drop_all(self) -> list[asyncio.Task]:
+        """Stop handing out the current sessions; each closes once its requests finish. Returns their tasks."""
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        for session in sessions:
+            session["stop"].set()
+        return [session["task"] for session in sessions]
+
+    async def close_all(self):
+        await asyncio.gather(*self._opening.values(), return_exceptions=True)
+        await asyncio.gather(*self.drop_all(), return_exceptions=True)
+
 
-# MCP availability is checked lazily in create_agent()
+mcp_health = MCPHealthMonitor(CAVE_MCP_URL, MCP_HEALTH_INTERVAL)
+mcp_sessions = MCPSessionPool(MCP_SESSION_POOL_SIZE, MCP_SESSION_TTL)
 
 AGENT_INSTRUCTIONS = """Caving assistant. Help with exploration, safety, surveying, locations, geology, equipment, history, conservation.
 
@@ -89,51 +290,39 @@ Rules:
 3. For rescue, accident, or emergency-related queries, use priority_prefixes=['nss/aca'] when searching."""
 
 
-def create_search_limiter():
-    """Block searches after the first one."""
-    searched = [False]
-
-    async def process_tool_call(
-        ctx: RunContext,
-        call_tool: CallToolFunc,
-        name: str,
-        tool_args: dict,
-    ):
-        if name == "search_caving_documents":
-            if searched[0]:
-                return "You have already searched. Use the results you have."
-            searched[0] = True
-        return await call_tool(name, tool_args)
+@dataclass
+class AgentDeps:
+    """Per-request state; MCP sessions are shared between requests, so it can't live on them."""
 
-    return process_tool_call
+    searched: bool = False
+    # whether a search returned results; answers written without them aren't worth caching
+    search_ok: bool = False
 
 
-def create_agent(user_roles: list[str] | None = None, sources_only: bool = False):
-    """Create an agent with MCP tools configured for the given user roles."""
+async def limit_searches(
+    ctx: RunContext[AgentDeps],
+    call_tool: CallToolFunc,
+    name: str,
+    tool_args: dict,
+):
+    """Block searches after the first one."""
+    if name == "search_caving_documents":
+        if ctx.deps.searched:
+            return "You have already searched. Use the results you have."
+        ctx.deps.searched = True
+        result = await call_tool(name, tool_args)
+        ctx.deps.search_ok = True
+        return result
+    return await call_tool(name, tool_args)
+
+
+async def create_agent(user_roles: list[str] | None = None, sources_only: bool = False) -> Agent[AgentDeps]:
+    """Create an agent with MCP tools configured for the given user roles; run it with AgentDeps()."""
     toolsets = []
 
-    # Check MCP availability lazily (each request) to handle startup race conditions
-    mcp_available = check_mcp_available(CAVE_MCP_URL) if user_roles else False
-
-    if mcp_available and user_roles:
+    if mcp_health.available and user_roles:
         try:
-            import json
-            from pydantic_ai.mcp import MCPServerStreamableHTTP
-
-            roles_header = json.dumps(user_roles)
-            logger.info(f"Creating MCP server with roles: {roles_header}")
-
-            mcp_server = MCPServerStreamableHTTP(
-                url=CAVE_MCP_URL,
-                headers={
-                    "x-user-roles": roles_header,
-                    "x-sources-only": "true" if sources_only else "false",
-                },
-                timeout=30.0,
-                process_tool_call=create_search_limiter(),
-            )
-            toolsets.append(mcp_server)
-            logger.info(f"MCP server configured with roles: {user_roles}")
+            toolsets.append(await mcp_sessions.get(user_roles, sources_only))
         except Exception as e:
             logger.warning(f"Could not configure MCP server: {e}")
     elif not user_roles:
@@ -146,6 +335,7 @@ def create_agent(user_roles: list[str] | None = None, sources_only: bool = False
 
     return Agent(
         model="anthropic:claude-sonnet-4-5",
+        deps_type=AgentDeps,
         toolsets=toolsets if toolsets else None,
         instructions=instructions,
         history_processors=[limit_history],
@@ -0,0 +1,102 @@
+"""
+Semantic cache of agent answers, so repeated questions skip the model run and MCP search.
+"""
+
+import os
+import math
+import logging
+
+import cohere
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+COHERE_API_KEY = os.getenv("COHERE_API_KEY", "")
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(24 * 60 * 60)))
+# cosine similarity above which two questions share an answer; only used when COHERE_API_KEY is set
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a question so trivially different phrasings share an answer."""
+    return " ".join(query.lower().split()).rstrip("?!. ")
+
+
+class AnswerCache:
+    """Answers keyed by (roles, sources_only, question). Questions are matched exactly, or by embedding similarity
+    when COHERE_API_KEY is set. Everything is dropped when the MCP server's corpus version changes."""
+
+    def __init__(self, maxsize: int, ttl: float, similarity: float):
+        self.similarity = similarity
+        self.corpus_version: str | None = None
+        self._entries: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._co = cohere.AsyncClientV2(COHERE_API_KEY) if COHERE_API_KEY else None
+
+    def set_corpus_version(self, version: str | None):
+        if version != self.corpus_version:
+            if self._entries:
+                logger.info(f"Corpus changed ({self.corpus_version} -> {version}), clearing answer cache")
+            self._entries.clear()
+            self.corpus_version = version
+
+    async def embed(self, query: str) -> list[float] | None:
+        """Unit-length embedding of the question, or None if embeddings aren't available."""
+        if self._co is None:
+            return None
+        try:
+            resp = await self._co.embed(
+                texts=[query],
+                model="embed-v4.0",
+                input_type="search_query",
+                embedding_types=["float"],
+                output_dimension=256,
+            )
+        except Exception as e:
+            logger.warning(f"Failed to embed question for the answer cache: {e}")
+            return None
+        assert resp.embeddings.float_ is not None
+        embedding = resp.embeddings.float_[0]
+        norm = math.sqrt(math.sumprod(embedding, embedding)) or 1.0
+        return [x / norm for x in embedding]
+
+    async def get(self, query: str, roles: list[str], sources_only: bool) -> tuple[str | None, list[float] | None]:
+        """Return (cached answer or None, question embedding to pass to set)."""
+        if self.corpus_version is None:
+            return None, None
+        scope = (tuple(sorted(roles)), sources_only)
+        query = normalize_query(query)
+        entry = self._entries.get((*scope, query))
+        if entry is not None:
+            return entry[1], entry[0]
+
+        embedding = await self.embed(query)
+        if embedding is None:
+            return None, None
+        self._entries.expire()
+        best, best_similarity = None, self.similarity
+        for key, (cached_embedding, answer) in self._entries.items():
+            if key[:2] != scope or cached_embedding is None:
+                continue
+            similarity = math.sumprod(embedding, cached_embedding)
+            if similarity >= best_similarity:
+                best, best_similarity = answer, similarity
+        return best, embedding
+
+    def set(
+        self,
+        query: str,
+        roles: list[str],
+        sources_only: bool,
+        embedding: list[float] | None,
+        answer: str,
+        corpus_version: str | None,
+    ):
+        """Cache an answer generated against corpus_version; it's dropped if the corpus has changed since."""
+        # without a corpus version, there's no way to tell when the answer goes stale
+        if corpus_version is None or corpus_version != self.corpus_version:
+            return
+        self._entries[(tuple(sorted(roles)), sources_only, normalize_query(query))] = (embedding, answer)
+
+
+answer_cache = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_SIMILARITY)
@@ -40,62 +40,163 @@ if not os.getenv("ANTHROPIC_API_KEY"):
     logger.error("ANTHROPIC_API_KEY environment variable is required")
     sys.exit(1)
 
+import uuid
+import asyncio
+import contextlib
 import uvicorn
+from ag_ui.core import (
+    RunAgentInput,
+    RunFinishedEvent,
+    RunStartedEvent,
+    TextMessageContentEvent,
+    TextMessageEndEvent,
+    TextMessageStartEvent,
+    UserMessage,
+)
+from pydantic import ValidationError
 from starlette.applications import Starlette
 from starlette.requests import Request
 from starlette.responses import Response, JSONResponse
 from starlette.routing import Route
 
-from pydantic_ai.ui.ag_ui import AGUIAdapter
+from pydantic_ai.ui.ag_ui import AGUIAdapter, AGUIEventStream
 
-from src.agent import create_agent
+from src.agent import AgentDeps, create_agent, mcp_health, mcp_sessions
+from src.answer_cache import answer_cache
+from src.sources import format_sources, search_sources
 
 logger.info("Creating AG-UI app...")
 
 
-async def handle_agent_request(request: Request) -> Response:
-    """Handle incoming AG-UI requests with dynamic role-based MCP configuration."""
-
-    # Extract user roles from request headers
+def get_user_roles(request: Request) -> list[str]:
+    """Extract user roles from the x-user-roles header."""
     roles_header = request.headers.get("x-user-roles", "")
-    user_roles = []
-
     if roles_header:
         try:
             user_roles = json.loads(roles_header)
             logger.info(f"Request received with roles: {user_roles}")
+            return user_roles
         except json.JSONDecodeError as e:
             logger.warning(f"Failed to parse x-user-roles header: {e}")
+    return []
+
+
+async def handle_agent_request(request: Request) -> Response:
+    """Handle incoming AG-UI requests with dynamic role-based MCP configuration."""
+
+    # Extract user roles from request headers
+    user_roles = get_user_roles(request)
 
     # Extract sources-only mode from header
     sources_only = request.headers.get("x-sources-only", "false") == "true"
     if sources_only:
         logger.info("Sources-only mode enabled")
 
+    # Answer repeated questions from the cache; only the last user message matters, see limit_history
+    try:
+        run_input = AGUIAdapter.build_run_input(await request.body())
+    except ValidationError:
+        run_input = None
+    query = last_user_message(run_input) if run_input else None
+
+    # Sources-only answers are just the search results, so skip the model
+    if sources_only and query:
+        try:
+            answer = format_sources(await search_sources(query, user_roles))
+        except Exception as e:
+            logger.warning(f"Direct sources search failed, falling back to the agent: {e}")
+        else:
+            event_stream = AGUIEventStream(run_input, accept=request.headers.get("accept"))
+            return event_stream.streaming_response(replay_answer(run_input, answer))
+
+    corpus_version = answer_cache.corpus_version
+    embedding = None
+    if query:
+        answer, embedding = await answer_cache.get(query, user_roles, sources_only)
+        if answer is not None:
+            logger.info("Answered from the answer cache")
+            event_stream = AGUIEventStream(run_input, accept=request.headers.get("accept"))
+            return event_stream.streaming_response(replay_answer(run_input, answer))
+
+    deps = AgentDeps()
+
+    async def cache_answer(result):
+        # answers written without search results (MCP was down, or the search failed) aren't worth repeating
+        if query and isinstance(result.output, str) and result.output and (deps.search_ok or not user_roles):
+            answer_cache.set(query, user_roles, sources_only, embedding, result.output, corpus_version)
+
     # Create agent with the user's roles and mode
-    agent = create_agent(user_roles, sources_only=sources_only)
+    agent = await create_agent(user_roles, sources_only=sources_only)
 
-    # Dispatch the request - tool limits handled by ToolCallLimiter in agent.py
+    # Dispatch the request - the search limit is tracked per request in AgentDeps
     return await AGUIAdapter.dispatch_request(
         request,
         agent=agent,
+        deps=deps,
         usage_limits=UsageLimits(
             request_limit=10,     # Safety net for runaway requests
         ),
         model_settings=ModelSettings(max_tokens=4096),
+        on_complete=cache_answer,
     )
 
 
+def last_user_message(run_input: RunAgentInput) -> str | None:
+    """The text of the conversation's last message, if the user sent it."""
+    if run_input.messages and isinstance(run_input.messages[-1], UserMessage):
+        content = run_input.messages[-1].content
+        return content if isinstance(content, str) else None
+    return None
+
+
+async def replay_answer(run_input: RunAgentInput, answer: str):
+    """AG-UI events for a cached answer, as if the agent had just written it."""
+    message_id = str(uuid.uuid4())
+    yield RunStartedEvent(thread_id=run_input.thread_id, run_id=run_input.run_id)
+    yield TextMessageStartEvent(message_id=message_id, role="assistant")
+    yield TextMessageContentEvent(message_id=message_id, delta=answer)
+    yield TextMessageEndEvent(message_id=message_id)
+    yield RunFinishedEvent(thread_id=run_input.thread_id, run_id=run_input.run_id)
+
+
+async def handle_sources_request(request: Request) -> Response:
+    """Search for sources without running the agent: {"query": ...} -> {"sources": [{key, title, relevance}], "text"}."""
+    try:
+        query = (await request.json())["query"]
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return JSONResponse({"error": "Expected a JSON body with a query"}, status_code=400)
+
+    try:
+        sources = await search_sources(query, get_user_roles(request))
+    except Exception as e:
+        logger.error(f"Sources search failed: {e}", exc_info=True)
+        return JSONResponse({"error": "Search is unavailable"}, status_code=503)
+    return JSONResponse({"sources": sources, "text": format_sources(sources)})
+
+
 async def health(request: Request) -> Response:
     """Health check endpoint."""
     return JSONResponse({"status": "ok"})
 
 
+@contextlib.asynccontextmanager
+async def lifespan(app: Starlette):
+    """Check MCP health in the background, and close pooled MCP sessions on shutdown."""
+    monitor = asyncio.create_task(mcp_health.run())
+    try:
+        yield
+    finally:
+        monitor.cancel()
+        await mcp_sessions.close_all()
+
+
 app = Starlette(
     routes=[
         Route("/", handle_agent_request, methods=["POST"]),
+        Route("/sources", handle_sources_request, methods=["POST"]),
         Route("/health", health, methods=["GET"]),
     ],
+    lifespan=lifespan,
 )
 
 logger.info("AG-UI app created successfully")
@@ -0,0 +1,74 @@
+"""
+Sources-only search: calls the MCP search directly and formats the results without an LLM.
+"""
+
+import re
+import logging
+
+from src.agent import mcp_health, mcp_sessions
+
+logger = logging.getLogger(__name__)
+
+# the agent is told to prioritize official accident reports for these, see AGENT_INSTRUCTIONS
+PRIORITY_PATTERN = re.compile(r"\b(rescue|accident|emergenc|injur|incident|fatal)", re.IGNORECASE)
+YEAR_PATTERN = re.compile(r"^(19|20)\d\d$")
+SMALL_WORDS = {"a", "an", "and", "at", "by", "for", "in", "of", "on", "or", "the", "to"}
+
+
+def title_case(word: str, first: bool) -> str:
+    """Capitalize a word of a title, leaving acronyms and numbers as they are."""
+    if any(c.isdigit() or c.isupper() for c in word):
+        return word
+    if not first and word in SMALL_WORDS:
+        return word
+    return word.capitalize()
+
+
+def format_source_title(key: str) -> str:
+    """Turn a page key into a readable title, e.g. "vpi/trog/2021-trog.pdf/page-19.pdf" -> "Trog 2021, page 19"."""
+    page = None
+    match = re.match(r"^(.*)/page-(\d+)\.pdf$", key)
+    if match:
+        key, page = match.group(1), match.group(2)
+
+    name = key.rsplit("/", 1)[-1]
+    name = re.sub(r"\.pdf$", "", name, flags=re.IGNORECASE)
+    words = [word for word in re.split(r"[-_\s]+", name) if word]
+    # a leading year reads better at the end: "2021 trog" -> "Trog 2021"
+    if len(words) > 1 and YEAR_PATTERN.match(words[0]):
+        words = words[1:] + words[:1]
+    title = " ".join(title_case(word, first=i == 0) for i, word in enumerate(words)) or key
+
+    return f"{title}, page {page}" if page else title
+
+
+async def search_sources(query: str, user_roles: list[str]) -> list[dict]:
+    """Search with the MCP server in sources-only mode, returning [{key, title, relevance}], best first.
+
+    Raises if the MCP server is down, so callers don't mistake that for a search with no matches."""
+    if not user_roles:
+        return []
+    if not mcp_health.available:
+        raise RuntimeError("MCP server unavailable")
+
+    args: dict = {"query": query}
+    if PRIORITY_PATTERN.search(query):
+        args["priority_prefixes"] = ["nss/aca"]
+
+    server = await mcp_sessions.get(user_roles, sources_only=True)
+    result = await server.direct_call_tool("search_caving_documents", args)
+    results = result.get("results", []) if isinstance(result, dict) else []
+    return [
+        {"key": row["key"], "title": format_source_title(row["key"]), "relevance": row.get("relevance")}
+        for row in results
+        if row.get("key")
+    ]
+
+
+def format_sources(sources: list[dict]) -> str:
+    """A bulleted list of source titles, like the sources-only agent used to write."""
+    if not sources:
+        return "No sources found."
+    # several pages of one document can match; list each title once
+    titles = dict.fromkeys(source["title"] for source in sources)
+    return "\n".join(f"- {title}" for title in titles)